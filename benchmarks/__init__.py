@@ -0,0 +1,2 @@
+"""Офлайн-бенчмарки бота: команды вызываются напрямую на заглушках Discord,
+без подключения к шлюзу. Запуск: python -m benchmarks --help"""
@@ -0,0 +1,68 @@
+"""Запуск всех размеров наборов данных, каждый в отдельном процессе (чтобы пиковая память
+не смешивалась между прогонами), и вывод сводной таблицы.
+
+    python -m benchmarks --users 1000 10000 100000 --ops 500 --backend json
+    python -m benchmarks --json > baseline.jsonl   # сохранить результат для сравнения
+    python -m benchmarks --compare baseline.jsonl  # сравнить текущий код с сохраненным
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+from benchmarks.runner import SCENARIOS
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+def run_size(users: int, args) -> list:
+    command = [sys.executable, "-m", "benchmarks.runner", "--users", str(users), "--ops", str(args.ops),
+               "--backend", args.backend, "--seed", str(args.seed), "--scenarios", *args.scenarios]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return [json.loads(line) for line in output.splitlines() if line.startswith("{")]
+
+
+def load_baseline(path: str) -> dict:
+    with open(path, 'r', encoding='utf-8') as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    return {(row["users"], row["scenario"]): row for row in rows}
+
+
+def print_table(results: list, baseline: dict):
+    header = f"{'users':>7} {'scenario':<22} {'ops/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'RSS MB':>8}"
+    if baseline:
+        header += f" {'p50 vs base':>12}"
+    print(header)
+    for row in results:
+        line = (f"{row['users']:>7} {row['scenario']:<22} {row['ops_per_sec']:>10.1f} "
+                f"{row['p50_ms']:>9.3f} {row['p99_ms']:>9.3f} {row['peak_rss_mb']:>8.1f}")
+        base = baseline.get((row["users"], row["scenario"]))
+        if base and base["p50_ms"]:
+            line += f" {row['p50_ms'] / base['p50_ms']:>11.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки команд бота")
+    parser.add_argument("--users", type=int, nargs="+", default=DEFAULT_SIZES, help="Размеры наборов данных")
+    parser.add_argument("--ops", type=int, default=500, help="Операций на сценарий")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--backend", default="json", choices=["json", "sqlite"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Вывести строки JSON вместо таблицы")
+    parser.add_argument("--compare", metavar="BASELINE", help="Файл с результатами --json для сравнения")
+    args = parser.parse_args()
+
+    results = []
+    for users in args.users:
+        results.extend(run_size(users, args))
+
+    if args.json:
+        for row in results:
+            print(json.dumps(row, ensure_ascii=False))
+    else:
+        print_table(results, load_baseline(args.compare) if args.compare else {})
+
+
+if __name__ == "__main__":
+    main()
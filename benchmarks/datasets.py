@@ -0,0 +1,53 @@
+"""Синтетические наборы данных: N игроков одного сервера с балансами, инвентарями и кейсами"""
+import json
+import os
+import random
+
+import bot
+
+GUILD_ID = 100000000000000001
+FIRST_USER_ID = 200000000000000000
+PAYOUT_CHANNEL_ID = bot.ADMIN_PAYOUT_CHANNEL_ID
+
+CASES = {
+    "Обычный": {
+        "items": [{"item": item, "chance": 10} for item in list(bot.ITEM_CURRENCY_REWARDS)]
+                 + [{"item": f"Хлам {i}", "chance": 30} for i in range(20)],
+        "price": {"currency": "Рубли", "amount": 100},
+    },
+    "Редкий": {
+        "items": [{"item": item, "chance": 5} for item in bot.ITEM_ROLES]
+                 + [{"item": f"Трофей {i}", "chance": 1 + i % 7} for i in range(300)],
+        "price": {"currency": "Рубли", "amount": 1000},
+    },
+}
+
+
+def user_ids(users: int):
+    return [str(FIRST_USER_ID + i) for i in range(users)]
+
+
+def generate(directory: str, users: int, seed: int = 0):
+    """Записывает в directory файлы данных бота для одного сервера с users игроками"""
+    rng = random.Random(seed)
+    server_id = str(GUILD_ID)
+    item_pool = list(bot.ITEM_ROLES) + list(bot.ITEM_CURRENCY_REWARDS) + [f"Хлам {i}" for i in range(20)]
+
+    currency = {}
+    inventory = {}
+    admin_currency = {}
+    for index, user_id in enumerate(user_ids(users)):
+        currency[user_id] = {name: rng.randint(10_000, 10_000_000) for name in bot.CURRENCIES}
+        inventory[user_id] = {item: rng.randint(1, 50) for item in rng.sample(item_pool, rng.randint(0, 12))}
+        if index % 100 == 0:
+            admin_currency[user_id] = rng.randint(0, 5000)
+
+    files = {
+        bot.CURRENCY_FILE: {server_id: currency},
+        bot.INVENTORY_FILE: {server_id: inventory},
+        bot.ADMIN_CURRENCY_FILE: {server_id: admin_currency},
+        bot.CASES_FILE: CASES,
+    }
+    for filename, data in files.items():
+        with open(os.path.join(directory, filename), 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
@@ -0,0 +1,91 @@
+"""Заглушки объектов Discord (контекст, сервер, участники, роли), достаточные для вызова команд"""
+from typing import Dict, List, Optional
+
+
+class FakeAvatar:
+    url = "https://cdn.discordapp.com/embed/avatars/0.png"
+
+
+class FakeRole:
+    def __init__(self, role_id: int, name: str):
+        self.id = role_id
+        self.name = name
+        self.mention = f"<@&{role_id}>"
+        self.members: List["FakeMember"] = []
+
+
+class FakeMember:
+    def __init__(self, member_id: int, guild: "FakeGuild"):
+        self.id = member_id
+        self.guild = guild
+        self.display_name = f"Игрок {member_id}"
+        self.mention = f"<@{member_id}>"
+        self.display_avatar = FakeAvatar()
+        self.roles: List[FakeRole] = []
+
+    async def add_roles(self, *roles):
+        self.roles.extend(roles)
+
+
+class FakeMessage:
+    """Отправленное сообщение; хранит только последний embed и view"""
+
+    def __init__(self, channel: "FakeChannel", content=None, embed=None, embeds=None, view=None):
+        self.id = channel.sent
+        self.channel = channel
+        self.content = content
+        self.embed = embed or (embeds[0] if embeds else None)
+        self.view = view
+
+    async def edit(self, content=None, embed=None, view=None, **kwargs):
+        self.embed = embed or self.embed
+        self.view = view
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.sent = 0
+        self.last_message: Optional[FakeMessage] = None
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        self.last_message = FakeMessage(self, content, **kwargs)
+        return self.last_message
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.members: Dict[int, FakeMember] = {}
+        self.roles: Dict[int, FakeRole] = {}
+        self.channels: Dict[int, FakeChannel] = {}
+
+    def get_member(self, member_id: int) -> Optional[FakeMember]:
+        return self.members.get(member_id)
+
+    def get_role(self, role_id: int) -> Optional[FakeRole]:
+        return self.roles.get(role_id)
+
+    def get_channel(self, channel_id: int) -> Optional[FakeChannel]:
+        return self.channels.get(channel_id)
+
+    def add_member(self, member_id: int) -> FakeMember:
+        member = self.members[member_id] = FakeMember(member_id, self)
+        return member
+
+    def add_role(self, role_id: int, name: str) -> FakeRole:
+        role = self.roles[role_id] = FakeRole(role_id, name)
+        return role
+
+
+class FakeContext:
+    """Аналог commands.Context: сервер, автор и канал для ответов"""
+
+    def __init__(self, guild: FakeGuild, author: FakeMember, channel: Optional[FakeChannel] = None):
+        self.guild = guild
+        self.author = author
+        self.channel = channel or FakeChannel(0)
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
@@ -0,0 +1,181 @@
+"""Прогон сценариев на одном наборе данных.
+Запуск отдельного размера: python -m benchmarks.runner --users 10000"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+import bot
+from benchmarks import datasets
+from benchmarks.harness import FakeChannel, FakeContext, FakeGuild
+
+STAFF_SHARE = 100  # Каждый сотый игрок получает ежедневную админ-выплату
+
+
+class Environment:
+    """Изолированное окружение: данные во временной папке, свое хранилище и заглушка сервера"""
+
+    def __init__(self, directory: str, users: int, backend: str, seed: int):
+        os.chdir(directory)
+        datasets.generate(directory, users, seed)
+        if backend == 'sqlite':
+            bot.migrate_json_to_sqlite()
+            storage = bot.SQLiteBackend(bot.DATABASE_FILE)
+        else:
+            storage = bot.JsonBackend()
+
+        bot.store = bot.DataStore(storage, journal=bot.Journal(os.path.join(directory, bot.JOURNAL_FILE)))
+        bot.leaderboards = bot.LeaderboardIndex()
+        bot.CaseSystem.samplers.clear()
+
+        self.rng = random.Random(seed)
+        self.guild = FakeGuild(datasets.GUILD_ID)
+        self.guild.channels[datasets.PAYOUT_CHANNEL_ID] = FakeChannel(datasets.PAYOUT_CHANNEL_ID)
+        roles = [self.guild.add_role(role_id, f"Роль {role_id}") for role_id in bot.DAILY_ADMIN_ROLES]
+        self.members = []
+        for index, user_id in enumerate(datasets.user_ids(users)):
+            member = self.guild.add_member(int(user_id))
+            self.members.append(member)
+            if index % STAFF_SHARE == 0:
+                role = roles[index // STAFF_SHARE % len(roles)]
+                role.members.append(member)
+                member.roles.append(role)
+
+    async def load(self):
+        await asyncio.gather(*(bot.store.load_async(filename) for filename in
+                               (bot.INVENTORY_FILE, bot.CURRENCY_FILE, bot.CASES_FILE, bot.ADMIN_CURRENCY_FILE)))
+
+    def member(self):
+        return self.rng.choice(self.members)
+
+    def context(self):
+        return FakeContext(self.guild, self.member())
+
+
+# --- Сценарии: один вызов = одна операция ---
+async def open_case(env: Environment):
+    await bot.open_case.callback(env.context(), env.rng.choice(list(datasets.CASES)))
+
+
+async def transfer(env: Environment):
+    await bot.transfer.callback(env.context(), env.member(), "Рубли", env.rng.randint(1, 100))
+
+
+async def show_inventory(env: Environment):
+    await bot.show_inventory.callback(env.context())
+
+
+async def execute_trade(env: Environment):
+    ctx = env.context()
+    recipient = env.member()
+    while recipient is ctx.author:
+        recipient = env.member()
+    server_id = str(env.guild.id)
+    # Тот же путь, что у кнопок: реестр обменов, подтверждения с эскроу, завершение
+    session = bot.trades.start(env.guild, ctx.author, recipient)
+    if session is None:
+        return
+    owned = bot.get_inventory(server_id, str(ctx.author.id))
+    if owned:
+        session.set_offer(True, items={next(iter(owned)): 1})
+    session.set_offer(True, currency={"Рубли": 10})
+    session.set_offer(False, currency={"Доллары": 1})
+    if session.confirm(ctx.author.id) and session.confirm(recipient.id):
+        session.complete()
+    bot.trades.end(session)
+
+
+async def process_daily_payout(env: Environment):
+    # Выплата вызывается напрямую, в обход расписания планировщика
+    await bot.AdminCurrencySystem.process_daily_payout(env.guild)
+
+
+SCENARIOS: Dict[str, Callable] = {
+    "open_case": open_case,
+    "transfer": transfer,
+    "show_inventory": show_inventory,
+    "execute_trade": execute_trade,
+    "process_daily_payout": process_daily_payout,
+}
+HEAVY_SCENARIOS = {"process_daily_payout": 20}  # Ограничение числа операций для тяжелых сценариев
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run_scenario(env: Environment, name: str, ops: int) -> dict:
+    scenario = SCENARIOS[name]
+    ops = min(ops, HEAVY_SCENARIOS.get(name, ops))
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(ops):
+        op_started = time.perf_counter()
+        await scenario(env)
+        latencies.append(time.perf_counter() - op_started)
+    elapsed = time.perf_counter() - started
+    return {
+        "scenario": name,
+        "ops": ops,
+        "ops_per_sec": ops / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+async def run(users: int, ops: int, scenarios: List[str], backend: str, seed: int) -> List[dict]:
+    with tempfile.TemporaryDirectory(prefix="bot-bench-") as directory:
+        cwd = os.getcwd()
+        try:
+            env = Environment(directory, users, backend, seed)
+            started = time.perf_counter()
+            await env.load()
+            results = [{"scenario": "load", "ops": 1, "ops_per_sec": 0.0,
+                        "p50_ms": (time.perf_counter() - started) * 1000, "p99_ms": 0.0,
+                        "peak_rss_mb": peak_rss_mb()}]
+            for name in scenarios:
+                results.append(await run_scenario(env, name, ops))
+
+            # Отдельно меряем сброс накопленных изменений на диск
+            started = time.perf_counter()
+            await bot.store.flush_async()
+            results.append({"scenario": "flush", "ops": 1, "ops_per_sec": 0.0,
+                            "p50_ms": (time.perf_counter() - started) * 1000, "p99_ms": 0.0,
+                            "peak_rss_mb": peak_rss_mb()})
+        finally:
+            os.chdir(cwd)
+    for result in results:
+        result.update(users=users, backend=backend)
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Прогон сценариев бота на синтетическом наборе данных")
+    parser.add_argument("--users", type=int, default=1000, help="Игроков на сервере")
+    parser.add_argument("--ops", type=int, default=1000, help="Операций на сценарий")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--backend", default="json", choices=["json", "sqlite"])
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(run(args.users, args.ops, args.scenarios, args.backend, args.seed))
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,15 +6,80 @@ import os
 import random
 import datetime
 import asyncio
-from typing import Dict, Optional, List
+import contextlib
+import sqlite3
+import sys
+import copy
+import time
+import contextvars
+import bisect
+import threading
+import struct
+import zlib
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from typing import Dict, Optional, List, Tuple
 
-bot = commands.Bot(command_prefix='+', intents=discord.Intents.all())
+# Шардирование: SHARD_COUNT > 0 включает AutoShardedBot, SHARD_IDS ("0,1") - шарды этого процесса
+# (пусто - все шарды в одном процессе). В этом режиме данные хранятся отдельно по серверам
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0'))
+SHARD_IDS = [int(shard) for shard in os.getenv('SHARD_IDS', '').split(',') if shard.strip()] or None
+
+if SHARD_IDS and not SHARD_COUNT:
+    raise SystemExit("SHARD_IDS задан без SHARD_COUNT: укажите общее число шардов")
+if SHARD_IDS and any(not 0 <= shard < SHARD_COUNT for shard in SHARD_IDS):
+    raise SystemExit(f"SHARD_IDS {SHARD_IDS} вне диапазона 0..{SHARD_COUNT - 1}")
+
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix='+', intents=discord.Intents.all(),
+                                  shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix='+', intents=discord.Intents.all())
 
 # Конфигурация
 INVENTORY_FILE = 'inventory.json'
 CURRENCY_FILE = 'currency.json'
 CASES_FILE = 'cases.json'
 ITEMS_PER_PAGE = 5
+MAX_CASES_PER_OPEN = 100  # Сколько кейсов можно открыть одной командой
+EMBED_DESCRIPTION_LIMIT = 4096  # Ограничение Discord на длину описания embed
+EMBED_FIELD_LIMIT = 1024  # Ограничение Discord на длину значения поля embed
+EMBED_TOTAL_LIMIT = 6000  # Ограничение Discord на суммарную длину текста embed
+CASES_PER_PAGE = 5  # Кейсов на одной странице +списоккейсов
+INTERACTION_DEBOUNCE = 0.5  # Не чаще одного редактирования сообщения с кнопками за столько секунд
+IDEMPOTENCY_TTL = 300  # Сколько секунд помнить выполненные операции (повторы в этот срок игнорируются)
+# Ограничение нажатий на пользователя: команда -> (нажатий подряд, восполнение в секунду)
+INTERACTION_RATE_LIMITS = {
+    'default': (5, 1.0),
+    'inventory': (8, 2.0),
+    'role_items': (8, 2.0),
+    'cases': (8, 2.0),
+    'trade': (3, 0.5),
+}
+FLUSH_DELAY = 30  # Через сколько секунд после изменения данные сбрасываются на диск
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')  # 'json' или 'sqlite'
+DATABASE_FILE = 'economy.db'
+IO_WORKERS = 2  # Размер пула потоков для работы с диском
+METRICS_HOST = '127.0.0.1'  # Эндпоинт метрик доступен только локально
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))  # 0 - не запускать эндпоинт
+JOURNAL_FILE = 'journal.log'  # Журнал изменений, еще не сброшенных на диск
+if SHARD_IDS:
+    JOURNAL_FILE = f"journal.shard{'-'.join(map(str, SHARD_IDS))}.log"  # У каждого процесса свой журнал
+DATA_DIR = os.getenv('DATA_DIR', 'data')  # Данные по серверам в режиме шардирования: DATA_DIR/<server_id>/<файл>
+# Журнал движений валюты заменяет хранилище валюты (currency.json или таблицу currency в SQLite):
+# при первом запуске балансы переносятся в журнал, после этого STORAGE_BACKEND валюту больше не пишет.
+# Запуск с CURRENCY_LEDGER=0 после работы с журналом вернет балансы на момент переноса
+CURRENCY_LEDGER = os.getenv('CURRENCY_LEDGER', '1') == '1'
+LEDGER_DIR = 'ledger'  # Журналы движений валюты: LEDGER_DIR/<server_id>.ledger
+LEDGER_BOOTSTRAPPED = '.bootstrapped'  # Отметка в LEDGER_DIR: валюта уже перенесена из прежнего хранилища
+LEDGER_COMPACT_RECORDS = 50_000  # Сколько лишних записей копится в журнале сервера до его сжатия в снимок
+LEDGER_OPEN_FILES = 64  # Сколько журналов серверов держать открытыми (давно не использованные закрываются)
+JOURNAL_SYNC_DELAY = 0.5  # Как часто журнал принудительно сбрасывается на диск (fsync)
+SNAPSHOT_DIR = 'snapshots'  # Снимки экономики: SNAPSHOT_DIR/<server_id>/<id>.json и blobs/<хэш>.json
+SNAPSHOT_INTERVAL = 3600  # Как часто снимки делаются автоматически (0 - только командой)
+SNAPSHOT_KEEP = 48  # Сколько последних снимков сервера хранится
+SNAPSHOT_BUCKETS = 256  # На сколько частей по игрокам делится раздел в снимке (переписываются только измененные)
 
 ALLOWED_ROLE_IDS = [1113130639261179928, 1373964737293058098]  # ID ролей с правами управления
 ADMIN_ROLE_IDS = [1113130639261179928, 1373964737293058098]    # ID админских ролей
@@ -61,97 +126,1635 @@ DAILY_ADMIN_ROLES = {
     1373964737293058098: 50
 }
 
-# Время следующей выплаты (глобальная переменная)
-next_daily_payout = None
-
 ADMIN_PAYOUT_CHANNEL_ID = 1386008000640192552  # Замените на реальный ID канала для уведомлений
 
+# Периодические задачи экономики. Время следующего запуска хранится по серверам в SCHEDULE_FILE,
+# поэтому перезапуск бота не вызывает внеочередных выплат и не сдвигает расписание
+SCHEDULE_FILE = 'schedule.json'
+ESCROW_FILE = 'escrow.json'  # Предметы и валюта подтвердивших обмен игроков до завершения сделки
+TRADE_TIMEOUT = 300  # Через сколько секунд без нажатий обмен отменяется, а эскроу возвращается
+GLOBAL_FILES = {CASES_FILE}  # Файлы, общие для всех серверов (не делятся по шардам)
+# При нескольких процессах (SHARD_IDS) общие файлы пишет только процесс шарда 0,
+# остальные перечитывают их раз в GLOBAL_RELOAD_INTERVAL секунд
+GLOBAL_RELOAD_INTERVAL = 60
+DAILY_PAYOUT_INTERVAL = 24 * 3600  # Интервал выплаты админ-валюты, в секундах
+INTEREST_INTERVAL = 24 * 3600
+INTEREST_RATES = {}  # Начисление процентов на балансы: валюта -> процент за интервал (пусто - выключено)
+DECAY_INTERVAL = 24 * 3600
+DECAY_RATES = {}  # Списание с крупных балансов: валюта -> процент от суммы выше порога (пусто - выключено)
+DECAY_THRESHOLD = 1_000_000  # Баланс, выше которого действует списание
+SCHEDULER_CONCURRENCY = 8  # Сколько серверов обрабатываются одновременно при рассылке задач
+
+# --- Метрики ---
+class Histogram:
+    """Гистограмма длительностей с фиксированными границами (в секундах)"""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по верхней границе корзины"""
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return self.BUCKETS[-1]
+
+class Metrics:
+    """Метрики горячих путей: время команд, работа с файлами и запросы к Discord HTTP API"""
+
+    def __init__(self):
+        self.lock = threading.Lock()  # Файловые метрики пишутся и из потоков пула
+        self.commands: Dict[str, Histogram] = {}
+        self.command_errors: Dict[str, int] = {}
+        self.command_http: Dict[str, float] = {}  # Сколько времени команда ждала Discord API
+        self.io: Dict[Tuple[str, str], Histogram] = {}  # (операция, файл)
+        self.io_bytes: Dict[Tuple[str, str], int] = {}
+        self.http: Dict[Tuple[str, str], Histogram] = {}  # (метод, маршрут)
+        self.current_command = contextvars.ContextVar('current_command', default=None)
+        self.server = None
+
+    def observe_command(self, name: str, seconds: float, failed: bool = False):
+        self.commands.setdefault(name, Histogram()).observe(seconds)
+        if failed:
+            self.command_errors[name] = self.command_errors.get(name, 0) + 1
+
+    @contextlib.contextmanager
+    def time_io(self, operation: str, filename: str, size: int = 0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            key = (operation, os.path.basename(filename))
+            with self.lock:
+                self.io.setdefault(key, Histogram()).observe(elapsed)
+                self.io_bytes[key] = self.io_bytes.get(key, 0) + size
+
+    def add_bytes(self, operation: str, filename: str, size: int):
+        key = (operation, os.path.basename(filename))
+        with self.lock:
+            self.io_bytes[key] = self.io_bytes.get(key, 0) + size
+
+    def observe_http(self, method: str, path: str, seconds: float):
+        self.http.setdefault((method, path), Histogram()).observe(seconds)
+        command = self.current_command.get()
+        if command:
+            self.command_http[command] = self.command_http.get(command, 0.0) + seconds
+
+    def render_prometheus(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+        lines = []
+
+        def histogram(name: str, labels: str, hist: Histogram):
+            cumulative = 0
+            for bound, count in zip(Histogram.BUCKETS, hist.counts):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{labels}}} {hist.sum}')
+            lines.append(f'{name}_count{{{labels}}} {hist.count}')
+
+        lines.append("# TYPE bot_command_seconds histogram")
+        for name, hist in self.commands.items():
+            histogram("bot_command_seconds", f'command="{name}"', hist)
+        lines.append("# TYPE bot_command_errors_total counter")
+        for name, count in self.command_errors.items():
+            lines.append(f'bot_command_errors_total{{command="{name}"}} {count}')
+        lines.append("# TYPE bot_command_http_seconds_total counter")
+        for name, seconds in self.command_http.items():
+            lines.append(f'bot_command_http_seconds_total{{command="{name}"}} {seconds}')
+        with self.lock:
+            io = list(self.io.items())
+            io_bytes = list(self.io_bytes.items())
+        lines.append("# TYPE bot_storage_seconds histogram")
+        for (operation, filename), hist in io:
+            histogram("bot_storage_seconds", f'op="{operation}",file="{filename}"', hist)
+        lines.append("# TYPE bot_storage_bytes_total counter")
+        for (operation, filename), size in io_bytes:
+            lines.append(f'bot_storage_bytes_total{{op="{operation}",file="{filename}"}} {size}')
+        lines.append("# TYPE bot_discord_http_seconds histogram")
+        for (method, path), hist in self.http.items():
+            histogram("bot_discord_http_seconds", f'method="{method}",route="{path}"', hist)
+        return "\n".join(lines) + "\n"
+
+    async def handle_scrape(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Минимальный HTTP обработчик для GET /metrics"""
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if request.split(b" ")[1:2] == [b"/metrics"]:
+                body = self.render_prometheus().encode('utf-8')
+                head = "HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            else:
+                body = b"not found\n"
+                head = "HTTP/1.0 404 Not Found\r\nContent-Type: text/plain\r\n"
+            writer.write(f"{head}Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start_server(self):
+        """Запускает локальный эндпоинт для Prometheus (один раз за время работы)"""
+        if self.server is None and METRICS_PORT:
+            self.server = await asyncio.start_server(self.handle_scrape, METRICS_HOST, METRICS_PORT)
+
+metrics = Metrics()
+
+def instrument_http(http):
+    """Оборачивает HTTP клиент discord.py, чтобы считать запросы к API по маршрутам"""
+    original_request = http.request
+
+    async def request(route, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await original_request(route, **kwargs)
+        finally:
+            metrics.observe_http(route.method, route.path, time.perf_counter() - start)
+
+    http.request = request
+
+instrument_http(bot.http)
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = time.perf_counter()
+    metrics.current_command.set(ctx.command.qualified_name)
+
+@bot.after_invoke
+async def record_command_time(ctx):
+    metrics.observe_command(ctx.command.qualified_name, time.perf_counter() - ctx.started_at,
+                            failed=ctx.command_failed)
+
 # --- Система хранения данных ---
 def load_data(filename: str) -> dict:
     """Загрузка данных из JSON файла"""
     if not os.path.exists(filename):
         return {}
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except:
-        return {}
+        with metrics.time_io('read', filename, os.path.getsize(filename)):
+            with open(filename, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    except json.JSONDecodeError as e:
+        # Не подменяем поврежденный файл пустыми данными: следующая запись стерла бы все
+        raise RuntimeError(f"Файл {filename} поврежден, загрузка остановлена: {e}") from e
+
+def write_atomic(filename: str, text: str):
+    """Атомарная запись: временный файл, fsync и переименование поверх старого"""
+    tmp_filename = filename + '.tmp'
+    data = text.encode('utf-8')
+    with metrics.time_io('write', filename, len(data)):
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
 
 def save_data(data: dict, filename: str):
     """Сохранение данных в JSON файл"""
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    write_atomic(filename, json.dumps(data, ensure_ascii=False, indent=4))
+
+def ensure_data_file(filename: str):
+    """Создает пустой файл данных, если его нет"""
+    if not os.path.exists(filename):
+        save_data({}, filename)
+
+def dump_fragment(value, level: int = 1) -> str:
+    """Сериализует вложенное значение с отступом, как его пишет json.dump(indent=4)"""
+    return json.dumps(value, ensure_ascii=False, indent=4).replace("\n", "\n" + "    " * level)
+
+def join_fragments(fragments: dict, level: int = 0) -> str:
+    """Собирает JSON объект из уже сериализованных значений"""
+    if not fragments:
+        return "{}"
+    indent = "    " * (level + 1)
+    parts = []
+    for key, fragment in fragments.items():
+        if isinstance(fragment, dict):
+            fragment = join_fragments(fragment, level + 1)
+        parts.append(f"{indent}{json.dumps(key, ensure_ascii=False)}: {fragment}")
+    return "{\n" + ",\n".join(parts) + "\n" + "    " * level + "}"
+
+def owns_guild(key: str) -> bool:
+    """Относится ли раздел (ID сервера) к шардам этого процесса"""
+    if not SHARD_IDS or not key.isdigit():
+        return True
+    return (int(key) >> 22) % SHARD_COUNT in SHARD_IDS
+
+def owns_global_files() -> bool:
+    """Пишет ли этот процесс общие файлы (GLOBAL_FILES): единственный процесс или процесс шарда 0"""
+    return not SHARD_IDS or 0 in SHARD_IDS
+
+class JsonBackend:
+    """Хранение данных в JSON файлах"""
+
+    def __init__(self):
+        # Кэш сериализованных значений: файл -> раздел -> пользователь -> текст
+        self.fragments: Dict[str, Dict[str, dict]] = {}
+
+    @staticmethod
+    def partition_fragments(value):
+        if isinstance(value, dict):
+            return {user_id: dump_fragment(item, 2) for user_id, item in value.items()}
+        return dump_fragment(value)
+
+    def load(self, filename: str) -> dict:
+        data = load_data(filename)
+        if isinstance(data, dict):
+            self.fragments[filename] = {key: self.partition_fragments(value) for key, value in data.items()}
+        else:
+            self.fragments[filename] = {}
+        return data
+
+    def write(self, filename: str, changes: Dict[str, tuple]):
+        """Переписывает файл, пересериализуя только измененные записи"""
+        fragments = self.fragments.setdefault(filename, {})
+        for key, (users, value) in changes.items():
+            if value is None and users is None:
+                fragments.pop(key, None)
+            elif users is None or not isinstance(fragments.get(key), dict):
+                fragments[key] = self.partition_fragments(value)
+            else:
+                partition = fragments[key]
+                for user_id in users:
+                    if user_id in value:
+                        partition[user_id] = dump_fragment(value[user_id], 2)
+                    else:
+                        partition.pop(user_id, None)
+
+        with metrics.time_io('serialize', filename):
+            text = join_fragments(fragments)
+        write_atomic(filename, text)
+
+class GuildPartitionedBackend:
+    """Хранение по серверам: DATA_DIR/<server_id>/<файл>. Процесс читает и пишет только
+    разделы серверов своих шардов, общие файлы (кейсы) остаются в корне"""
+
+    def __init__(self, inner=None, directory: str = DATA_DIR):
+        self.inner = inner or JsonBackend()
+        self.directory = directory
+
+    def path(self, key: str, filename: str) -> str:
+        return os.path.join(self.directory, key, filename)
+
+    def load(self, filename: str) -> dict:
+        if filename in GLOBAL_FILES:
+            return self.inner.load(filename)
+        data = {}
+        if os.path.isdir(self.directory):
+            for key in os.listdir(self.directory):
+                path = self.path(key, filename)
+                if owns_guild(key) and os.path.exists(path):
+                    data.update(self.inner.load(path))
+        return data
+
+    def write(self, filename: str, changes: Dict[str, tuple]):
+        """Переписывает только файлы измененных серверов"""
+        if filename in GLOBAL_FILES:
+            return self.inner.write(filename, changes)
+        for key, change in changes.items():
+            path = self.path(key, filename)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.inner.write(path, {key: change})
+
+class SQLiteBackend:
+    """Хранение данных в SQLite: индексированные таблицы по (guild_id, user_id), режим WAL"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS currency (
+            guild_id TEXT NOT NULL, user_id TEXT NOT NULL, currency TEXT NOT NULL, amount INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, user_id, currency)
+        );
+        CREATE TABLE IF NOT EXISTS admin_currency (
+            guild_id TEXT NOT NULL, user_id TEXT NOT NULL, amount INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS inventory (
+            guild_id TEXT NOT NULL, user_id TEXT NOT NULL, items TEXT NOT NULL,
+            PRIMARY KEY (guild_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS cases (
+            name TEXT PRIMARY KEY, data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS schedule (
+            guild_id TEXT NOT NULL, job TEXT NOT NULL, next_run REAL NOT NULL,
+            PRIMARY KEY (guild_id, job)
+        );
+        CREATE TABLE IF NOT EXISTS escrow (
+            guild_id TEXT NOT NULL, user_id TEXT NOT NULL, data TEXT NOT NULL,
+            PRIMARY KEY (guild_id, user_id)
+        );
+    """
+
+    def __init__(self, path: str = DATABASE_FILE):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()  # Соединение используется из потоков пула ввода-вывода
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        # Для каждого файла: (загрузка строк, удаление раздела, удаление пользователя, сохранение строк)
+        self.tables = {
+            CURRENCY_FILE: (self.load_currency, "DELETE FROM currency WHERE guild_id = ?",
+                            "DELETE FROM currency WHERE guild_id = ? AND user_id = ?", self.currency_rows),
+            ADMIN_CURRENCY_FILE: (self.load_admin_currency, "DELETE FROM admin_currency WHERE guild_id = ?",
+                                  "DELETE FROM admin_currency WHERE guild_id = ? AND user_id = ?", self.admin_currency_rows),
+            INVENTORY_FILE: (self.load_inventory, "DELETE FROM inventory WHERE guild_id = ?",
+                             "DELETE FROM inventory WHERE guild_id = ? AND user_id = ?", self.inventory_rows),
+            CASES_FILE: (self.load_cases, "DELETE FROM cases WHERE name = ?", None, self.case_rows),
+            SCHEDULE_FILE: (self.load_schedule, "DELETE FROM schedule WHERE guild_id = ?",
+                            "DELETE FROM schedule WHERE guild_id = ? AND job = ?", self.schedule_rows),
+            ESCROW_FILE: (self.load_escrow, "DELETE FROM escrow WHERE guild_id = ?",
+                          "DELETE FROM escrow WHERE guild_id = ? AND user_id = ?", self.escrow_rows),
+        }
+
+    def load(self, filename: str) -> dict:
+        with metrics.time_io('read', filename):
+            data = self.tables[filename][0]()
+        if SHARD_IDS and filename not in GLOBAL_FILES:
+            data = {key: value for key, value in data.items() if owns_guild(key)}
+        return data
+
+    def load_currency(self) -> dict:
+        data = {}
+        for guild_id, user_id, currency, amount in self.conn.execute(
+                "SELECT guild_id, user_id, currency, amount FROM currency"):
+            data.setdefault(guild_id, {}).setdefault(user_id, {})[currency] = amount
+        return data
+
+    def load_admin_currency(self) -> dict:
+        data = {}
+        for guild_id, user_id, amount in self.conn.execute(
+                "SELECT guild_id, user_id, amount FROM admin_currency"):
+            data.setdefault(guild_id, {})[user_id] = amount
+        return data
+
+    def load_inventory(self) -> dict:
+        data = {}
+        for guild_id, user_id, items in self.conn.execute(
+                "SELECT guild_id, user_id, items FROM inventory"):
+            data.setdefault(guild_id, {})[user_id] = json.loads(items)
+        return data
+
+    def load_cases(self) -> dict:
+        return {name: json.loads(case) for name, case in self.conn.execute("SELECT name, data FROM cases")}
+
+    def load_schedule(self) -> dict:
+        data = {}
+        for guild_id, job, next_run in self.conn.execute("SELECT guild_id, job, next_run FROM schedule"):
+            data.setdefault(guild_id, {})[job] = next_run
+        return data
+
+    def load_escrow(self) -> dict:
+        data = {}
+        for guild_id, user_id, held in self.conn.execute("SELECT guild_id, user_id, data FROM escrow"):
+            data.setdefault(guild_id, {})[user_id] = json.loads(held)
+        return data
+
+    @staticmethod
+    def currency_rows(guild_id, user_id, balances):
+        return "INSERT OR REPLACE INTO currency VALUES (?, ?, ?, ?)", [
+            (guild_id, user_id, currency, amount) for currency, amount in balances.items()]
+
+    @staticmethod
+    def admin_currency_rows(guild_id, user_id, amount):
+        return "INSERT OR REPLACE INTO admin_currency VALUES (?, ?, ?)", [(guild_id, user_id, amount)]
+
+    @staticmethod
+    def inventory_rows(guild_id, user_id, items):
+        return "INSERT OR REPLACE INTO inventory VALUES (?, ?, ?)", [
+            (guild_id, user_id, json.dumps(items, ensure_ascii=False))]
+
+    @staticmethod
+    def escrow_rows(guild_id, user_id, held):
+        return "INSERT OR REPLACE INTO escrow VALUES (?, ?, ?)", [
+            (guild_id, user_id, json.dumps(held, ensure_ascii=False))]
+
+    @staticmethod
+    def schedule_rows(guild_id, job, next_run):
+        return "INSERT OR REPLACE INTO schedule VALUES (?, ?, ?)", [(guild_id, job, next_run)]
+
+    @staticmethod
+    def case_rows(name, case):
+        return "INSERT OR REPLACE INTO cases VALUES (?, ?)", [(name, json.dumps(case, ensure_ascii=False))]
+
+    def write(self, filename: str, changes: Dict[str, tuple]):
+        """Точечно обновляет только измененные строки в одной транзакции"""
+        _, delete_partition, delete_user, rows = self.tables[filename]
+        with self.lock, metrics.time_io('write', filename), self.conn:
+            for key, (users, value) in changes.items():
+                if users is None or delete_user is None:
+                    # Изменен весь раздел: переписываем его целиком
+                    self.conn.execute(delete_partition, (key,))
+                    if value is None:
+                        continue
+                    if delete_user is None:
+                        self.conn.executemany(*rows(key, value))
+                    else:
+                        for user_id, item in value.items():
+                            self.conn.executemany(*rows(key, user_id, item))
+                    continue
+                for user_id in users:
+                    self.conn.execute(delete_user, (key, user_id))
+                    if user_id in value:
+                        self.conn.executemany(*rows(key, user_id, value[user_id]))
+
+def create_backend():
+    """Создает хранилище, выбранное в STORAGE_BACKEND"""
+    if STORAGE_BACKEND == 'sqlite':
+        return SQLiteBackend(DATABASE_FILE)
+    if SHARD_COUNT:
+        return GuildPartitionedBackend(JsonBackend(), DATA_DIR)
+    return JsonBackend()
+
+def migrate_json_to_sqlite():
+    """Одноразовый перенос данных из JSON файлов в базу SQLite"""
+    backend = SQLiteBackend(DATABASE_FILE)
+    for filename in (CURRENCY_FILE, ADMIN_CURRENCY_FILE, INVENTORY_FILE, CASES_FILE, SCHEDULE_FILE):
+        data = load_data(filename)
+        if isinstance(data, list):
+            # Старый формат кейсов приводится к новому при загрузке через CaseSystem
+            print(f"[Миграция] {filename}: устаревший формат, пропущен")
+            continue
+        backend.write(filename, {key: (None, value) for key, value in data.items()})
+        print(f"[Миграция] {filename}: перенесено разделов: {len(data)}")
+    backend.conn.close()
+
+def migrate_json_to_guild_dirs():
+    """Одноразовое разделение общих JSON файлов по серверам для режима шардирования"""
+    for filename in (CURRENCY_FILE, ADMIN_CURRENCY_FILE, INVENTORY_FILE, SCHEDULE_FILE):
+        data = load_data(filename)
+        for key, value in data.items():
+            os.makedirs(os.path.join(DATA_DIR, key), exist_ok=True)
+            save_data({key: value}, os.path.join(DATA_DIR, key, filename))
+        print(f"[Миграция] {filename}: разделено по серверам: {len(data)}")
+
+class AsyncPersistence:
+    """Выполняет чтение, сериализацию и запись в ограниченном пуле потоков,
+    не блокируя цикл событий. Для каждого файла одновременно работает только один писатель"""
+
+    def __init__(self, max_workers: int = IO_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="storage")
+        self.locks: Dict[str, asyncio.Lock] = {}
+
+    async def run(self, filename: str, func, *args):
+        """Выполняет func(*args) в пуле, по очереди с другими операциями над тем же файлом"""
+        lock = self.locks.setdefault(filename, asyncio.Lock())
+        async with lock:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+class Journal:
+    """Журнал изменений (write-ahead): каждая мутация дописывается в конец сегмента,
+    а при старте сегменты воспроизводятся поверх данных, не успевших попасть на диск"""
+
+    def __init__(self, path: str = JOURNAL_FILE):
+        self.path = path
+        self.file = None
+        self.segment = max((self.segment_number(p) for p in self.segments()), default=0)
+
+    def segment_number(self, path: str) -> int:
+        return int(path.rsplit('.', 1)[1])
+
+    def segments(self) -> List[str]:
+        """Пути всех сегментов журнала по порядку"""
+        directory = os.path.dirname(self.path) or '.'
+        prefix = os.path.basename(self.path) + '.'
+        paths = [os.path.join(directory, name) for name in os.listdir(directory)
+                 if name.startswith(prefix) and name[len(prefix):].isdigit()]
+        return sorted(paths, key=self.segment_number)
+
+    def read(self) -> List[dict]:
+        """Читает все записи; оборванная при сбое последняя строка отбрасывается"""
+        records = []
+        for path in self.segments():
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+        return records
+
+    def open_segment(self):
+        """Начинает новый сегмент, возвращает файл предыдущего"""
+        old_file = self.file
+        self.segment += 1
+        self.file = open(f"{self.path}.{self.segment}", 'a', encoding='utf-8')
+        return old_file
+
+    def append(self, record: dict):
+        if self.file is None:
+            self.open_segment()
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def sync(self, file=None):
+        """fsync сегмента (выполняется в пуле потоков)"""
+        file = file or self.file
+        if file is not None and not file.closed:
+            os.fsync(file.fileno())
+
+    def close_segment(self, file):
+        self.sync(file)
+        file.close()
+
+    def discard(self, paths: List[str]):
+        """Удаляет сегменты, изменения из которых уже сохранены"""
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+class Ledger:
+    """Журнал движений валюты: по файлу на сервер, записи только дописываются в конец.
+    Запись - длина и CRC32 (по 4 байта), затем тип, время, сумма и строки (пользователь, валюта, причина).
+    Баланс восстанавливается из снимка (записи SET в начале файла) и дописанных после него изменений,
+    а сжатие атомарно переписывает файл новым снимком"""
+
+    DELTA, SET, REMOVE, CLEAR = 1, 2, 3, 4  # Изменение баланса, точное значение, удаление игрока, очистка сервера
+    BIG = 0x80  # Флаг типа: сумма не помещается в int64 и записана десятичной строкой после остальных полей
+    HEADER = struct.Struct('<II')
+    RECORD = struct.Struct('<Bdq')
+    BIG_LENGTH = struct.Struct('<H')
+
+    def __init__(self, directory: str = LEDGER_DIR):
+        self.directory = directory
+        # Процесс переносит только свои серверы, поэтому отметка у каждого набора шардов своя
+        suffix = f".shard{'-'.join(map(str, SHARD_IDS))}" if SHARD_IDS else ""
+        self.marker = os.path.join(directory, LEDGER_BOOTSTRAPPED + suffix)
+        self.files: Dict[str, object] = {}  # Открытые на дописывание файлы серверов, от давно использованных к недавним
+        self.unsynced: set = set()  # Серверы, записи которых еще не сброшены на диск (fsync)
+        self.records: Counter = Counter()  # Число записей в файле каждого сервера
+        self.notes: Dict[Tuple[str, str], List[Tuple[str, int]]] = {}  # Изменения, ожидающие записи
+        self.candidates: set = set()  # Серверы, журналы которых, возможно, пора сжать
+        self.compacting: set = set()
+        self.lock = threading.Lock()  # Файлы дописываются из цикла событий, а сжимаются и сбрасываются в пуле
+
+    def path(self, server_id: str) -> str:
+        return os.path.join(self.directory, f"{server_id}.ledger")
+
+    # --- Формат записей ---
+    @classmethod
+    def encode(cls, kind: int, user_id: str = "", currency: str = "", amount: int = 0, reason: str = "") -> bytes:
+        big = not -2 ** 63 <= amount < 2 ** 63
+        payload = cls.RECORD.pack(kind | cls.BIG if big else kind, time.time(), 0 if big else amount)
+        for text in (user_id, currency, reason):
+            # Обрезаем по границе символа, чтобы не разрезать многобайтный символ UTF-8
+            data = text.encode('utf-8')[:255].decode('utf-8', 'ignore').encode('utf-8')
+            payload += bytes((len(data),)) + data
+        if big:
+            digits = str(amount).encode('ascii')
+            payload += cls.BIG_LENGTH.pack(len(digits)) + digits
+        return cls.HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+    @classmethod
+    def decode(cls, data: bytes):
+        """Перебирает (конец записи, тип, время, пользователь, валюта, сумма, причина).
+        Останавливается на оборванной или поврежденной записи"""
+        offset = 0
+        while offset + cls.HEADER.size <= len(data):
+            length, crc = cls.HEADER.unpack_from(data, offset)
+            start = offset + cls.HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            kind, timestamp, amount = cls.RECORD.unpack_from(payload)
+            position = cls.RECORD.size
+            texts = []
+            for _ in range(3):
+                size = payload[position]
+                texts.append(payload[position + 1:position + 1 + size].decode('utf-8', 'replace'))
+                position += 1 + size
+            if kind & cls.BIG:
+                kind &= ~cls.BIG
+                (size,) = cls.BIG_LENGTH.unpack_from(payload, position)
+                position += cls.BIG_LENGTH.size
+                amount = int(payload[position:position + size])
+            offset = start + length
+            yield offset, kind, timestamp, texts[0], texts[1], amount, texts[2]
+
+    @classmethod
+    def apply(cls, partition: dict, kind: int, user_id: str, currency: str, amount: int):
+        if kind == cls.CLEAR:
+            partition.clear()
+        elif kind == cls.REMOVE:
+            partition.pop(user_id, None)
+        else:
+            balances = partition.setdefault(user_id, {})
+            if currency:  # SET без валюты только отмечает, что у игрока есть запись
+                balances[currency] = amount if kind == cls.SET else balances.get(currency, 0) + amount
+
+    # --- Загрузка ---
+    def replay(self, server_id: str) -> Optional[dict]:
+        """Восстанавливает балансы сервера; оборванный при сбое хвост файла обрезается"""
+        path = self.path(server_id)
+        with metrics.time_io('read', path, os.path.getsize(path)):
+            with open(path, 'rb') as f:
+                data = f.read()
+        partition = {}
+        end = 0
+        count = 0
+        for end, kind, _, user_id, currency, amount, _ in self.decode(data):
+            self.apply(partition, kind, user_id, currency, amount)
+            count += 1
+        if end < len(data):
+            print(f"[Журнал валюты] {path}: отброшено {len(data) - end} байт оборванной записи")
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+        self.records[server_id] = count
+        return partition
+
+    def load(self, bootstrap) -> dict:
+        """Загружает балансы всех серверов этого процесса. При первом запуске серверы, для которых
+        журнала еще нет, переносятся из прежнего хранилища (bootstrap() возвращает его данные) снимком;
+        после переноса ставится отметка, и прежнее хранилище больше не читается"""
+        os.makedirs(self.directory, exist_ok=True)
+        data = {}
+        for name in os.listdir(self.directory):
+            server_id, extension = os.path.splitext(name)
+            if extension == '.ledger' and owns_guild(server_id):
+                data[server_id] = self.replay(server_id)
+        if not os.path.exists(self.marker):
+            moved = 0
+            for server_id, partition in bootstrap().items():
+                if server_id not in data and isinstance(partition, dict):
+                    self.write_snapshot(server_id, partition)
+                    data[server_id] = partition
+                    moved += 1
+            with open(self.marker, 'w', encoding='utf-8') as f:
+                f.write(f"{time.time()}\n")
+                f.flush()
+                os.fsync(f.fileno())
+            print(f"[Журнал валюты] Перенесено серверов: {moved}; дальше валюта хранится только в {self.directory}")
+        # Очищенные серверы остаются в журнале записью CLEAR, но не в данных
+        return {server_id: partition for server_id, partition in data.items() if partition}
+
+    # --- Запись ---
+    def note(self, server_id: str, user_id: str, currency: str, delta: int):
+        """Запоминает изменение баланса; в журнал оно попадет при пометке данных измененными"""
+        if delta:
+            self.notes.setdefault((server_id, user_id), []).append((currency, delta))
+
+    def record(self, server_id: str, user_id: Optional[str], partition: Optional[dict]):
+        """Дописывает изменения раздела: отмеченные через note() - как DELTA, остальные - точными значениями"""
+        frames = self.frames(server_id, user_id, partition, metrics.current_command.get() or "system")
+        self.append(server_id, b"".join(frames), len(frames))
+
+    def record_many(self, server_id: str, user_ids: List[str], partition: Optional[dict]):
+        """То же, что record, для многих игроков одного сервера одной записью в файл"""
+        reason = metrics.current_command.get() or "system"
+        frames = []
+        for user_id in user_ids:
+            frames.extend(self.frames(server_id, user_id, partition, reason))
+        self.append(server_id, b"".join(frames), len(frames))
+
+    def frames(self, server_id: str, user_id: Optional[str], partition: Optional[dict], reason: str) -> List[bytes]:
+        frames = []
+        if user_id is None:
+            # Изменен весь раздел (замена или удаление данных сервера)
+            for key in [key for key in self.notes if key[0] == server_id]:
+                del self.notes[key]
+            frames.append(self.encode(self.CLEAR, reason=reason))
+            for uid, balances in (partition or {}).items():
+                frames.extend(self.snapshot_frames(uid, balances, reason))
+        elif partition is None or user_id not in partition:
+            self.notes.pop((server_id, user_id), None)
+            frames.append(self.encode(self.REMOVE, user_id, reason=reason))
+        else:
+            notes = self.notes.pop((server_id, user_id), None)
+            if notes:
+                frames.extend(self.encode(self.DELTA, user_id, currency, delta, reason) for currency, delta in notes)
+            else:
+                frames.extend(self.snapshot_frames(user_id, partition[user_id], reason))
+        return frames
+
+    def snapshot_frames(self, user_id: str, balances: dict, reason: str = "snapshot") -> List[bytes]:
+        if not balances:
+            return [self.encode(self.SET, user_id, reason=reason)]
+        return [self.encode(self.SET, user_id, currency, amount, reason) for currency, amount in balances.items()]
+
+    def append(self, server_id: str, data: bytes, count: int):
+        with self.lock:
+            file = self.files.pop(server_id, None)
+            if file is None:
+                if len(self.files) >= LEDGER_OPEN_FILES:
+                    # Закрываем давно не использованный журнал; его fsync (если нужен) сделает sync()
+                    self.files.pop(next(iter(self.files))).close()
+                file = open(self.path(server_id), 'ab')
+            self.files[server_id] = file
+            file.write(data)
+            file.flush()
+            self.unsynced.add(server_id)
+            self.records[server_id] += count
+            if self.records[server_id] > LEDGER_COMPACT_RECORDS:
+                self.candidates.add(server_id)
+        metrics.add_bytes('write', LEDGER_DIR, len(data))
+
+    def sync(self):
+        """fsync файлов, в которые дописывались записи (выполняется в пуле потоков).
+        Под блокировкой только забирается список файлов, сам fsync идет без нее"""
+        with self.lock:
+            servers, self.unsynced = self.unsynced, set()
+            # Копия дескриптора: пока идет fsync, файл могут закрыть (вытеснение, сжатие)
+            handles = [(server_id, os.dup(self.files[server_id].fileno()) if server_id in self.files else None)
+                       for server_id in servers]
+        for server_id, fd in handles:
+            if fd is None:
+                # Файл уже закрыт, но его данные могли еще не попасть на диск
+                try:
+                    fd = os.open(self.path(server_id), os.O_RDONLY)
+                except FileNotFoundError:
+                    continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        self.sync()
+        with self.lock:
+            for file in self.files.values():
+                file.close()
+            self.files.clear()
+
+    def forget(self, server_id: str):
+        """Удаляет журнал сервера целиком (для временных данных, например проверки бота)"""
+        with self.lock:
+            file = self.files.pop(server_id, None)
+            if file is not None:
+                file.close()
+            path = self.path(server_id)
+            if os.path.exists(path):
+                os.remove(path)
+            self.unsynced.discard(server_id)
+            self.candidates.discard(server_id)
+            self.records.pop(server_id, None)
+
+    # --- Сжатие ---
+    def needs_compaction(self, server_id: str, partition: dict) -> bool:
+        return self.records[server_id] > LEDGER_COMPACT_RECORDS + len(partition) * len(CURRENCIES)
+
+    def offset(self, server_id: str) -> int:
+        """Текущий размер файла сервера: все, что дописано до этого момента, войдет в снимок"""
+        path = self.path(server_id)
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    @staticmethod
+    def read_from(path: str, position: int) -> bytes:
+        try:
+            with open(path, 'rb') as f:
+                f.seek(position)
+                return f.read()
+        except FileNotFoundError:
+            return b""
+
+    def write_snapshot(self, server_id: str, partition: dict, offset: Optional[int] = None):
+        """Атомарно переписывает журнал сервера: снимок partition (состояние на момент offset)
+        и записи, дописанные после offset, пока снимок писался.
+        Сжатая часть журнала не теряется, а дописывается в архив <server_id>.archive"""
+        path = self.path(server_id)
+        tmp_path = path + '.tmp'
+        if offset and os.path.exists(path):
+            # Начало файла до offset уже не меняется, копировать его можно без блокировки
+            with open(path, 'rb') as old, open(os.path.join(self.directory, f"{server_id}.archive"), 'ab') as archive:
+                archive.write(old.read(offset))
+                archive.flush()
+                os.fsync(archive.fileno())
+        frames = [self.encode(self.CLEAR, reason="snapshot")]
+        for user_id, balances in partition.items():
+            frames.extend(self.snapshot_frames(user_id, balances))
+        data = b"".join(frames)
+        tail = []
+        with metrics.time_io('write', path, len(data)):
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                # Записи, дописанные после offset, копируются без блокировки, пока хвост растет;
+                # под блокировкой (дописывание ждет) остаются только последние байты и замена файла
+                position = offset
+                for _ in range(3 if offset is not None else 0):
+                    chunk = self.read_from(path, position)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    tail.append(chunk)
+                    position += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+                with self.lock:
+                    if offset is not None and not os.path.exists(path):
+                        removed = True  # Журнал удален (forget), пока писался снимок
+                    else:
+                        removed = False
+                        old_file = self.files.pop(server_id, None)
+                        if old_file is not None:
+                            old_file.flush()
+                        chunk = self.read_from(path, position) if offset is not None else b""
+                        if chunk:
+                            f.write(chunk)
+                            f.flush()
+                            os.fsync(f.fileno())
+                            tail.append(chunk)
+                        os.replace(tmp_path, path)
+                        if old_file is not None:
+                            old_file.close()
+                        self.records[server_id] = len(frames)
+                        self.unsynced.discard(server_id)
+            if removed:
+                os.remove(tmp_path)
+                return
+        if tail:
+            count = sum(1 for _ in self.decode(b"".join(tail)))
+            with self.lock:
+                self.records[server_id] += count
+
+    def history(self, server_id: str, user_id: str, limit: int = 10) -> List[tuple]:
+        """Последние движения валюты игрока: (время, валюта, сумма, причина). Снимки не показываются"""
+        path = self.path(server_id)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'rb') as f:
+            data = f.read()
+        entries = [(timestamp, currency, amount, reason)
+                   for _, kind, timestamp, uid, currency, amount, reason in self.decode(data)
+                   if kind == self.DELTA and uid == user_id]
+        return entries[-limit:]
+
+def create_ledger() -> Optional[Ledger]:
+    """Создает журнал движений валюты, если он включен в CURRENCY_LEDGER"""
+    return Ledger(LEDGER_DIR) if CURRENCY_LEDGER else None
+
+class DataStore:
+    """Резидентное хранилище: каждый файл читается один раз, чтение идет из памяти,
+    изменения пишутся в журнал, помечают раздел (сервер) как грязный
+    и сбрасываются на диск фоновой задачей"""
+
+    def __init__(self, backend=None, flush_delay: float = FLUSH_DELAY, journal: Optional[Journal] = None,
+                 ledger: Optional[Ledger] = None):
+        self.backend = backend or create_backend()
+        # Валюта хранится журналом движений: изменения дописываются в него сразу, а не сбрасываются в файл
+        self.ledger = ledger if ledger is not None else create_ledger()
+        self.io = AsyncPersistence()
+        self.flush_delay = flush_delay
+        self.files: Dict[str, dict] = {}
+        # Грязные разделы: ключ раздела -> множество измененных пользователей (None - весь раздел)
+        self.dirty: Dict[str, Dict[str, Optional[set]]] = {}
+        # Игроки, измененные с последнего снимка: (файл, ключ) -> множество (None - весь раздел)
+        self.changes: Dict[Tuple[str, str], Optional[set]] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+        self.sync_task: Optional[asyncio.Task] = None
+
+        # Записи журнала прошлого запуска, еще не примененные к загруженным файлам
+        self.journal = journal or Journal(JOURNAL_FILE)
+        self.pending: Dict[str, List[dict]] = {}
+        for record in self.journal.read():
+            self.pending.setdefault(record["f"], []).append(record)
+
+    def attach(self, filename: str, data: dict):
+        """Регистрирует загруженные данные и применяет к ним записи журнала"""
+        self.files[filename] = data
+        self.dirty[filename] = {}
+        for record in self.pending.pop(filename, []):
+            key, user_id = record["k"], record["u"]
+            if "m" in record:
+                # Групповая запись: новые значения сразу для многих пользователей раздела
+                data.setdefault(key, {}).update(record["m"])
+                self.mark_dirty_many(filename, key, record["m"], journal=False)
+                continue
+            if user_id is None:
+                if record.get("d"):
+                    data.pop(key, None)
+                else:
+                    data[key] = record["v"]
+            elif record.get("d"):
+                data.get(key, {}).pop(user_id, None)
+            else:
+                data.setdefault(key, {})[user_id] = record["v"]
+            self.mark_dirty(filename, key, user_id, journal=False)
+
+    def read(self, filename: str) -> dict:
+        """Читает данные файла из хранилища (валюту - из журнала движений, если он включен)"""
+        if self.ledger and filename == CURRENCY_FILE:
+            return self.ledger.load(lambda: self.backend.load(filename))
+        return self.backend.load(filename)
+
+    def load(self, filename: str) -> dict:
+        """Возвращает данные файла, при первом обращении загружая его синхронно"""
+        if filename not in self.files:
+            self.attach(filename, self.read(filename))
+        return self.files[filename]
+
+    async def load_async(self, filename: str) -> dict:
+        """Загружает файл в пуле потоков (используется при старте бота)"""
+        if filename not in self.files:
+            data = await self.io.run(filename, self.read, filename)
+            if filename not in self.files:
+                self.attach(filename, data)
+        return self.files[filename]
+
+    async def reload(self, filename: str) -> bool:
+        """Перечитывает файл из хранилища; True, если данные изменились"""
+        data = await self.io.run(filename, self.backend.load, filename)
+        if data == self.files.get(filename):
+            return False
+        self.files[filename] = data
+        return True
+
+    def replace(self, filename: str, data: dict):
+        """Полностью заменяет данные файла (все разделы становятся грязными)"""
+        old = self.load(filename)
+        # Старый формат (например, список кейсов) не делится на разделы
+        old_keys = list(old) if isinstance(old, dict) else []
+        self.files[filename] = data
+        for key in old_keys + list(data):
+            self.mark_dirty(filename, key)
+
+    def delete(self, filename: str, key: str):
+        """Удаляет раздел целиком"""
+        if self.load(filename).pop(key, None) is not None:
+            self.mark_dirty(filename, key)
+
+    def partition(self, filename: str, key: str, create: bool = True) -> dict:
+        """Возвращает раздел файла (обычно данные одного сервера)"""
+        data = self.load(filename)
+        if key not in data:
+            if not create:
+                return {}
+            data[key] = {}
+        return data[key]
+
+    def mark_dirty(self, filename: str, key: str, user_id: Optional[str] = None, journal: bool = True):
+        """Записывает изменение в журнал, помечает раздел (или одного пользователя в нем)
+        как измененный и планирует сброс. Вызывается после изменения данных"""
+        data = self.load(filename)
+        self.note_changes(filename, key, None if user_id is None else (user_id,))
+        if filename in GLOBAL_FILES and not owns_global_files():
+            # Иначе сброс этого процесса затер бы изменения владельца файла (команды это не допускают)
+            return
+        if self.ledger and filename == CURRENCY_FILE:
+            # Журнал движений сам является хранилищем валюты: сбрасывать в файл нечего
+            self.ledger.record(key, user_id, data.get(key))
+            self.schedule_sync()
+            return
+        if journal:
+            value = data.get(key) if user_id is None else data.get(key, {}).get(user_id)
+            record = {"f": filename, "k": key, "u": user_id, "v": value}
+            if value is None:
+                record["d"] = True
+            self.journal.append(record)
+            self.schedule_sync()
+
+        dirty = self.dirty[filename]
+        if user_id is None:
+            dirty[key] = None
+        elif key not in dirty:
+            dirty[key] = {user_id}
+        elif dirty[key] is not None:
+            dirty[key].add(user_id)
+        self.schedule_flush()
+
+    def note_changes(self, filename: str, key: str, user_ids):
+        """Запоминает измененных игроков для следующего снимка (только файлы из SNAPSHOT_FILES)"""
+        if filename not in SNAPSHOT_FILES:
+            return
+        entry = (filename, key)
+        if user_ids is None:
+            self.changes[entry] = None
+        elif entry not in self.changes:
+            self.changes[entry] = set(user_ids)
+        elif self.changes[entry] is not None:
+            self.changes[entry].update(user_ids)
+
+    def take_changes(self, filename: str, key: str) -> Optional[set]:
+        """Забирает игроков, измененных с прошлого вызова (None - изменен весь раздел)"""
+        return self.changes.pop((filename, key), set())
+
+    def mark_dirty_many(self, filename: str, key: str, user_ids, journal: bool = True):
+        """То же, что mark_dirty, но для многих пользователей одного раздела сразу:
+        одна запись в журнале вместо записи на каждого пользователя"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        partition = self.load(filename).get(key, {})
+        self.note_changes(filename, key, user_ids)
+        if self.ledger and filename == CURRENCY_FILE:
+            self.ledger.record_many(key, user_ids, partition)
+            self.schedule_sync()
+            return
+        if journal:
+            self.journal.append({"f": filename, "k": key, "u": None,
+                                 "m": {user_id: partition.get(user_id) for user_id in user_ids}})
+            self.schedule_sync()
+
+        dirty = self.dirty[filename]
+        if key not in dirty:
+            dirty[key] = set(user_ids)
+        elif dirty[key] is not None:
+            dirty[key].update(user_ids)
+        self.schedule_flush()
+
+    def schedule_sync(self):
+        """Планирует групповой fsync журнала"""
+        if self.sync_task and not self.sync_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.sync_task = loop.create_task(self.delayed_sync())
+
+    async def delayed_sync(self):
+        await asyncio.sleep(JOURNAL_SYNC_DELAY)
+        await self.io.run(self.journal.path, self.journal.sync)
+        if self.ledger:
+            await self.io.run(LEDGER_DIR, self.ledger.sync)
+            # Валюта в режиме журнала не вызывает сброс, поэтому сжатие проверяется и здесь
+            await self.compact_ledger()
+
+    def schedule_flush(self):
+        """Планирует отложенный сброс, если он еще не запланирован"""
+        if self.flush_task and not self.flush_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # Вне цикла событий данные сбросятся при остановке бота
+        self.flush_task = loop.create_task(self.delayed_flush())
+
+    async def delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        await self.flush_async()
+
+    def collect_changes(self, filename: str) -> Dict[str, tuple]:
+        """Забирает грязные записи файла и копирует их, чтобы поток записи
+        не видел изменений, сделанных после этого момента"""
+        dirty = self.dirty[filename]
+        self.dirty[filename] = {}
+        data = self.files[filename]
+        changes = {}
+        for key, users in dirty.items():
+            partition = data.get(key)
+            if partition is None:
+                changes[key] = (None, None)
+            elif users is None:
+                changes[key] = (None, copy.deepcopy(partition))
+            else:
+                changes[key] = (users, {user_id: copy.deepcopy(partition[user_id])
+                                        for user_id in users if user_id in partition})
+        return changes
+
+    def restore_dirty(self, filename: str, changes: Dict[str, tuple]):
+        """Возвращает записи в грязные после неудачной записи"""
+        for key, (users, _) in changes.items():
+            for user_id in (users or [None]):
+                self.mark_dirty(filename, key, user_id, journal=False)
+
+    async def flush_async(self):
+        """Сбрасывает грязные записи в хранилище, не блокируя цикл событий.
+        Сегменты журнала удаляются только после успешной записи всех файлов"""
+        old_segments = self.journal.segments()
+        old_file = self.journal.open_segment()
+        if old_file is not None:
+            await self.io.run(self.journal.path, self.journal.close_segment, old_file)
+
+        ok = True
+        for filename in list(self.dirty):
+            if self.dirty[filename]:
+                changes = self.collect_changes(filename)
+                try:
+                    await self.io.run(filename, self.backend.write, filename, changes)
+                except Exception as e:
+                    ok = False
+                    self.restore_dirty(filename, changes)
+                    print(f"[Хранилище] Не удалось записать {filename}: {e}")
+
+        # Записи для еще не загруженных файлов остаются в старых сегментах
+        if ok and not self.pending:
+            await self.io.run(self.journal.path, self.journal.discard, old_segments)
+
+        if self.ledger:
+            await self.compact_ledger()
+
+        # Изменения, сделанные во время записи, остались грязными, а schedule_flush в это время
+        # ничего не планировал (задача сброса еще выполнялась) - планируем следующий сброс
+        task = self.flush_task
+        if any(self.dirty.values()) and (task is None or task.done() or task is asyncio.current_task()):
+            self.flush_task = None
+            self.schedule_flush()
+
+    async def compact_ledger(self):
+        """Сжимает журналы движений серверов, в которых накопилось слишком много записей"""
+        ledger = self.ledger
+        candidates, ledger.candidates = ledger.candidates - ledger.compacting, ledger.candidates & ledger.compacting
+        for server_id in candidates:
+            partition = self.files.get(CURRENCY_FILE, {}).get(server_id, {})
+            if not ledger.needs_compaction(server_id, partition):
+                continue
+            # Копия и смещение берутся одновременно: снимок отражает ровно записи до offset.
+            # Балансы - плоские словари {валюта: сумма}, поэтому deepcopy не нужен (он в разы медленнее)
+            snapshot = {user_id: dict(balances) for user_id, balances in partition.items()}
+            offset = ledger.offset(server_id)
+            ledger.compacting.add(server_id)
+            try:
+                await self.io.run(LEDGER_DIR, ledger.write_snapshot, server_id, snapshot, offset)
+            except Exception as e:
+                print(f"[Журнал валюты] Не удалось сжать журнал сервера {server_id}: {e}")
+            finally:
+                ledger.compacting.discard(server_id)
+
+    def flush(self):
+        """Синхронно сбрасывает грязные записи (при остановке бота)"""
+        for filename in list(self.dirty):
+            if self.dirty[filename]:
+                self.backend.write(filename, self.collect_changes(filename))
+        if self.journal.file is not None:
+            self.journal.close_segment(self.journal.file)
+            self.journal.file = None
+        if not self.pending:
+            self.journal.discard(self.journal.segments())
+        if self.ledger:
+            self.ledger.close()
+
+store = DataStore()
+
+class KeyedLocks:
+    """Асинхронные блокировки по ключу (сервер, пользователь).
+    Операции разных пользователей выполняются параллельно, одного - по очереди"""
+
+    def __init__(self):
+        self.locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        self.users: Dict[Tuple[str, str], int] = {}  # Сколько корутин держат или ждут ключ
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, server_id: str, *user_ids: str):
+        """Захватывает блокировки всех пользователей в отсортированном порядке (без взаимных блокировок)"""
+        keys = sorted({(server_id, user_id) for user_id in user_ids})
+        for key in keys:
+            if key not in self.locks:
+                self.locks[key] = asyncio.Lock()
+                self.users[key] = 0
+            self.users[key] += 1
+
+        acquired = []
+        try:
+            for key in keys:
+                await self.locks[key].acquire()
+                acquired.append(key)
+            yield
+        finally:
+            for key in reversed(acquired):
+                self.locks[key].release()
+            for key in keys:
+                self.users[key] -= 1
+                if not self.users[key]:
+                    # Никто больше не ждет ключ - освобождаем память
+                    del self.users[key]
+                    del self.locks[key]
+
+user_locks = KeyedLocks()
+
+# --- Вспомогательные функции инвентаря ---
+# Инвентарь хранится как {название предмета: количество}; названия интернируются,
+# поэтому одинаковые предметы у тысяч игроков ссылаются на одну строку
+def intern_item(item: str) -> str:
+    """Возвращает каноничный экземпляр названия предмета из каталога"""
+    return sys.intern(item)
+
+# Индекс для постраничного просмотра: (сервер, пользователь) -> (список предметов, общее количество).
+# Строится при открытии инвентаря и сбрасывается функциями, которые меняют инвентарь
+inventory_index: Dict[Tuple[str, str], Tuple[List[str], int]] = {}
+
+def user_inventory(server_id: str, user_id: str, create: bool = False) -> Dict[str, int]:
+    """Возвращает инвентарь пользователя {предмет: количество}, переводя старый формат (список)"""
+    partition = store.partition(INVENTORY_FILE, server_id, create=create)
+    items = partition.get(user_id)
+    if isinstance(items, list):
+        items = {intern_item(item): count for item, count in Counter(items).items()}
+        partition[user_id] = items
+        store.mark_dirty(INVENTORY_FILE, server_id, user_id)
+        inventory_index.pop((server_id, user_id), None)
+    elif items is None:
+        items = {}
+        if create:
+            partition[user_id] = items
+    return items
+
+def get_inventory(server_id: str, user_id: str) -> Dict[str, int]:
+    """Возвращает предметы пользователя с количеством"""
+    return user_inventory(server_id, user_id)
+
+def inventory_size(items: Dict[str, int]) -> int:
+    """Общее количество предметов в инвентаре"""
+    return sum(items.values())
+
+def add_to_inventory(server_id: str, user_id: str, *items: str, counts: Optional[Dict[str, int]] = None):
+    """Добавляет предметы (по одному или словарем {предмет: количество}) в инвентарь пользователя"""
+    inventory = user_inventory(server_id, user_id, create=True)
+    for item, count in (counts or Counter(items)).items():
+        item = intern_item(item)
+        inventory[item] = inventory.get(item, 0) + count
+    store.mark_dirty(INVENTORY_FILE, server_id, user_id)
+    inventory_index.pop((server_id, user_id), None)
+
+def remove_from_inventory(server_id: str, user_id: str, item: str, count: int = 1) -> bool:
+    """Удаляет count экземпляров предмета, возвращает False если их не хватает"""
+    inventory = user_inventory(server_id, user_id)
+    owned = inventory.get(item, 0)
+    if owned < count:
+        return False
+    if owned == count:
+        del inventory[item]
+    else:
+        inventory[item] = owned - count
+    store.mark_dirty(INVENTORY_FILE, server_id, user_id)
+    inventory_index.pop((server_id, user_id), None)
+    return True
+
+def clear_user_inventory(server_id: str, user_id: str) -> int:
+    """Очищает инвентарь пользователя, возвращает количество удаленных предметов"""
+    partition = store.partition(INVENTORY_FILE, server_id, create=False)
+    if user_id not in partition:
+        return 0
+    count = inventory_size(user_inventory(server_id, user_id))
+    partition[user_id] = {}
+    store.mark_dirty(INVENTORY_FILE, server_id, user_id)
+    inventory_index.pop((server_id, user_id), None)
+    return count
+
+def inventory_page_index(server_id: str, user_id: str) -> Tuple[List[str], int]:
+    """Список предметов в порядке инвентаря и их общее количество (из индекса)"""
+    entry = inventory_index.get((server_id, user_id))
+    if entry is None:
+        items = user_inventory(server_id, user_id)
+        entry = inventory_index[(server_id, user_id)] = (list(items), inventory_size(items))
+    return entry
+
+def inventory_page(server_id: str, user_id: str, offset: int, limit: int) -> List[Tuple[str, int]]:
+    """Пары (предмет, количество) одной страницы, начиная с offset"""
+    keys, _ = inventory_page_index(server_id, user_id)
+    items = user_inventory(server_id, user_id)
+    return [(item, items[item]) for item in keys[offset:offset + limit] if item in items]
+
+# --- Кэш ролей и имен участников ---
+class GuildCache:
+    """Кэш, общий для отрисовки инвентаря, кейсов и топов: упоминания ролей предметов
+    и отображаемые имена участников по каждому серверу. Сбрасывается событиями Discord"""
+
+    def __init__(self):
+        self.role_mentions: Dict[int, Dict[str, Optional[str]]] = {}  # Сервер -> предмет -> упоминание роли
+        self.names: Dict[int, Dict[int, Optional[str]]] = {}  # Сервер -> ID участника -> имя (None - не на сервере)
+
+    def item_roles(self, guild) -> Dict[str, Optional[str]]:
+        """Упоминания ролей для всех предметов из ITEM_ROLES (None, если роль не найдена)"""
+        mentions = self.role_mentions.get(guild.id)
+        if mentions is None:
+            mentions = {}
+            for item, role_id in ITEM_ROLES.items():
+                role = guild.get_role(role_id)
+                mentions[item] = role.mention if role else None
+            self.role_mentions[guild.id] = mentions
+        return mentions
+
+    def display_name(self, guild, user_id: int) -> Optional[str]:
+        """Отображаемое имя участника или None, если его нет на сервере"""
+        names = self.names.setdefault(guild.id, {})
+        if user_id not in names:
+            member = guild.get_member(user_id)
+            names[user_id] = member.display_name if member else None
+        return names[user_id]
+
+    def invalidate_roles(self, guild_id: int):
+        self.role_mentions.pop(guild_id, None)
+
+    def invalidate_member(self, guild_id: int, user_id: int):
+        self.names.get(guild_id, {}).pop(user_id, None)
+
+    def invalidate_user(self, user_id: int):
+        """Смена глобального имени пользователя: сбрасываем его на всех серверах"""
+        for names in self.names.values():
+            names.pop(user_id, None)
+
+    def invalidate_guild(self, guild_id: int):
+        self.role_mentions.pop(guild_id, None)
+        self.names.pop(guild_id, None)
+
+guild_cache = GuildCache()
+
+class EmbedCache:
+    """Готовые embed для каталогов, которые меняются редко (+рп, +команды, +списоккейсов).
+    Запись хранится по (каталог, сервер, страница) вместе с версией каталога; при изменении
+    каталога версия увеличивается и embed пересобирается при следующем запросе"""
+
+    def __init__(self):
+        self.entries: Dict[Tuple[str, Optional[int], int], tuple] = {}
+        self.versions: Counter = Counter()
+
+    def get(self, catalog: str, guild_id: Optional[int], build, page: int = 0):
+        """Возвращает embed (или список страниц) из кэша, собирая его через build() при промахе"""
+        version = self.versions[catalog]
+        key = (catalog, guild_id, page)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != version:
+            entry = self.entries[key] = (version, build())
+        return entry[1]
+
+    def bump(self, catalog: str):
+        """Каталог изменился: все сохраненные embed этого каталога устарели"""
+        self.versions[catalog] += 1
+
+    def invalidate(self, catalog: str, guild_id: Optional[int]):
+        """Сбрасывает все страницы каталога одного сервера"""
+        for key in [key for key in self.entries if key[0] == catalog and key[1] == guild_id]:
+            del self.entries[key]
+
+embed_cache = EmbedCache()
+
+@bot.event
+async def on_guild_role_create(role):
+    # Роль, созданная после заполнения кэша, должна находиться по ID предмета
+    guild_cache.invalidate_roles(role.guild.id)
+    embed_cache.invalidate('role_items', role.guild.id)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    guild_cache.invalidate_roles(after.guild.id)
+    embed_cache.invalidate('role_items', after.guild.id)
+
+@bot.event
+async def on_guild_role_delete(role):
+    guild_cache.invalidate_roles(role.guild.id)
+    embed_cache.invalidate('role_items', role.guild.id)
+
+@bot.event
+async def on_member_update(before, after):
+    guild_cache.invalidate_member(after.guild.id, after.id)
+
+@bot.event
+async def on_member_remove(member):
+    guild_cache.invalidate_member(member.guild.id, member.id)
+
+@bot.event
+async def on_user_update(before, after):
+    guild_cache.invalidate_user(after.id)
+
+@bot.event
+async def on_guild_remove(guild):
+    guild_cache.invalidate_guild(guild.id)
+    embed_cache.invalidate('role_items', guild.id)
+
+# --- Ограничение частоты нажатий ---
+class RateLimiter:
+    """Token bucket на пользователя и команду: сначала можно нажать capacity раз подряд,
+    дальше - не чаще rate нажатий в секунду"""
+
+    def __init__(self, limits: Dict[str, Tuple[int, float]]):
+        self.limits = limits
+        self.buckets: Dict[Tuple[str, int], Tuple[float, float]] = {}  # -> (токены, время обновления)
+
+    def allow(self, command: str, user_id: int) -> bool:
+        capacity, rate = self.limits.get(command, self.limits['default'])
+        now = time.monotonic()
+        key = (command, user_id)
+        tokens, updated = self.buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        allowed = tokens >= 1
+        self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+        if len(self.buckets) > 10000:
+            self.prune(now)
+        return allowed
+
+    def prune(self, now: float):
+        """Удаляет полностью восполненные корзины - они ничем не отличаются от новых"""
+        for key, (tokens, updated) in list(self.buckets.items()):
+            capacity, rate = self.limits.get(key[0], self.limits['default'])
+            if tokens + (now - updated) * rate >= capacity:
+                del self.buckets[key]
+
+class InteractionCoalescer:
+    """Склеивает частые нажатия на кнопки одного сообщения. Первое нажатие редактирует сообщение сразу,
+    следующие в течение INTERACTION_DEBOUNCE только подтверждаются (defer), а по истечении интервала
+    сообщение редактируется один раз - последним состоянием"""
+
+    def __init__(self, delay: float = INTERACTION_DEBOUNCE):
+        self.delay = delay
+        self.pending: Dict[int, tuple] = {}  # ID сообщения -> (последнее нажатие, render)
+        self.last_edit: Dict[int, float] = {}
+        self.locks: Dict[int, asyncio.Lock] = {}
+
+    async def edit(self, interaction, render):
+        """render() возвращает аргументы edit_message (может быть корутиной); вызывается
+        в момент отправки, поэтому отправляется самое свежее состояние"""
+        message_id = interaction.message.id
+        now = time.monotonic()
+        if message_id in self.pending:
+            await self.defer(message_id, interaction, render, self.pending[message_id])
+            return
+        wait = self.last_edit.get(message_id, 0) + self.delay - now
+        if wait <= 0 and not self.locked(message_id):
+            self.remember(message_id, now)
+            await interaction.response.edit_message(**await self.render(render))
+            return
+        # Отложенное редактирование планируется до await, чтобы запись в pending не осталась без него
+        asyncio.get_running_loop().create_task(self.flush_later(message_id, max(wait, 0)))
+        await self.defer(message_id, interaction, render, None)
+
+    async def defer(self, message_id: int, interaction, render, previous):
+        """Подтверждает нажатие и ставит его в очередь; если подтвердить не удалось,
+        возвращает в очередь предыдущее нажатие (или убирает запись)"""
+        self.pending[message_id] = (interaction, render)
+        try:
+            await interaction.response.defer()
+        except Exception:
+            entry = self.pending.get(message_id)
+            if entry and entry[0] is interaction:
+                if previous is None:
+                    del self.pending[message_id]
+                else:
+                    self.pending[message_id] = previous
+            raise
+
+    async def flush_later(self, message_id: int, wait: float):
+        await asyncio.sleep(wait)
+        lock = self.locks.setdefault(message_id, asyncio.Lock())
+        async with lock:
+            entry = self.pending.pop(message_id, None)
+            if entry is None:
+                return  # Сообщение уже отредактировано окончательно (edit_now)
+            interaction, render = entry
+            try:
+                await interaction.edit_original_response(**await self.render(render))
+            except discord.HTTPException as e:
+                print(f"Не удалось обновить сообщение {message_id}: {str(e)}")
+            finally:
+                self.remember(message_id, time.monotonic())
+        self.locks.pop(message_id, None)
+
+    async def edit_now(self, interaction, **kwargs):
+        """Немедленное редактирование (итоговое состояние): отменяет отложенное и
+        гарантированно выполняется после уже начатого"""
+        message_id = interaction.message.id
+        self.pending.pop(message_id, None)
+        lock = self.locks.get(message_id)
+        if lock and lock.locked():
+            await interaction.response.defer()
+            async with lock:
+                await interaction.edit_original_response(**kwargs)
+        else:
+            await interaction.response.edit_message(**kwargs)
+        self.remember(message_id, time.monotonic())
+
+    @staticmethod
+    async def render(render) -> dict:
+        kwargs = render()
+        return await kwargs if asyncio.iscoroutine(kwargs) else kwargs
+
+    def locked(self, message_id: int) -> bool:
+        lock = self.locks.get(message_id)
+        return bool(lock and lock.locked())
+
+    def remember(self, message_id: int, now: float):
+        self.last_edit[message_id] = now
+        if len(self.last_edit) > 10000:
+            self.last_edit = {key: value for key, value in self.last_edit.items() if now - value < self.delay}
+
+class IdempotencyCache:
+    """Ключи операций, которые уже выполнены или выполняются, с временем жизни ttl.
+    Повторное событие с тем же ключом (повтор шлюза, двойное нажатие) ничего не меняет"""
+
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL):
+        self.ttl = ttl
+        self.expires: Dict[str, float] = {}  # ключ -> момент, когда его можно забыть
+
+    def claim(self, key: str) -> bool:
+        """Занимает ключ; False, если операция с этим ключом уже была"""
+        now = time.monotonic()
+        if self.expires.get(key, 0) > now:
+            return False
+        self.expires[key] = now + self.ttl
+        if len(self.expires) > 10000:
+            self.expires = {key: expires for key, expires in self.expires.items() if expires > now}
+        return True
+
+    def release(self, key: str):
+        """Освобождает ключ операции, которая ничего не изменила (ее можно повторить)"""
+        self.expires.pop(key, None)
+
+rate_limiter = RateLimiter(INTERACTION_RATE_LIMITS)
+coalescer = InteractionCoalescer()
+operations = IdempotencyCache(IDEMPOTENCY_TTL)
+
+async def admit(interaction, command: str) -> bool:
+    """Проверяет лимит нажатий пользователя; при превышении отвечает скрытым сообщением"""
+    if rate_limiter.allow(command, interaction.user.id):
+        return True
+    await interaction.response.send_message("⏳ Слишком часто, подождите немного", ephemeral=True)
+    return False
+
+async def claim_operation(interaction, key: str) -> bool:
+    """Разрешает изменяющее действие один раз. Повторно доставленное событие молча пропускается
+    (на него уже ответили), а повтор операции получает скрытое сообщение"""
+    if not operations.claim(f"interaction:{interaction.id}"):
+        return False
+    if operations.claim(key):
+        return True
+    await interaction.response.send_message("ℹ️ Это действие уже выполнено", ephemeral=True)
+    return False
 
 # --- Система инвентаря ---
 class InventoryView(View):
-    def __init__(self, ctx, member, items):
+    """Постраничный просмотр инвентаря. Хранит только предметы текущей страницы,
+    кнопки создаются один раз и переиспользуются при смене страницы"""
+
+    def __init__(self, ctx, member):
         super().__init__(timeout=60)
         self.ctx = ctx
         self.member = member
-        self.items = items
+        self.server_id = str(ctx.guild.id)
+        self.user_id = str(member.id)
         self.current_page = 0
+        self.uses = 0  # Число использований: входит в ключ операции, чтобы двойное нажатие не срабатывало дважды
+        
+        # Кнопки использования: по одной на позицию страницы, предмет берется из self.page_items,
+        # а custom_id кнопки содержит метку предмета (см. slot_id)
+        self.use_buttons = []
+        for slot in range(ITEMS_PER_PAGE):
+            btn = Button(style=discord.ButtonStyle.green, label="Исп.", custom_id=f"use_{slot}")
+            btn.callback = lambda interaction, slot=slot: self.use_slot(interaction, slot)
+            self.use_buttons.append(btn)
+        
+        # Кнопки навигации
+        self.prev_btn = Button(style=discord.ButtonStyle.blurple, emoji="⬅️")
+        self.prev_btn.callback = self.prev_page
+        self.page_btn = Button(style=discord.ButtonStyle.gray, label="1/1", disabled=True)
+        self.next_btn = Button(style=discord.ButtonStyle.blurple, emoji="➡️")
+        self.next_btn.callback = self.next_page
+        
+        self.load_page()
+
+    def load_page(self):
+        """Читает из хранилища только предметы текущей страницы"""
+        keys, self.total = inventory_page_index(self.server_id, self.user_id)
+        self.item_count = len(keys)
+        self.page_count = max(1, (self.item_count + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE)
+        self.current_page = min(self.current_page, self.page_count - 1)
+        self.page_items = inventory_page(self.server_id, self.user_id,
+                                         self.current_page * ITEMS_PER_PAGE, ITEMS_PER_PAGE)
         self.update_buttons()
 
     def update_buttons(self):
-        """Обновляет кнопки для текущей страницы"""
+        """Обновляет подписи и состав кнопок для текущей страницы"""
         self.clear_items()
         
         # Кнопки для использования предметов
-        start_idx = self.current_page * ITEMS_PER_PAGE
-        end_idx = start_idx + ITEMS_PER_PAGE
-        
-        for i, item in enumerate(self.items[start_idx:end_idx], start_idx):
-            # Создаем кнопку только для предметов, которые можно использовать
+        for slot, (item, _) in enumerate(self.page_items):
+            # Показываем кнопку только для предметов, которые можно использовать
             if item in ITEM_ROLES or item in ITEM_CURRENCY_REWARDS:
-                btn = Button(
-                    style=discord.ButtonStyle.green,
-                    label=f"Исп. {item[:15]}",
-                    custom_id=f"use_{i}"
-                )
-                btn.callback = lambda interaction, idx=i, it=item: self.use_item(interaction, idx, it)
+                btn = self.use_buttons[slot]
+                btn.label = f"Исп. {item[:15]}"
+                btn.custom_id = self.slot_id(slot, item)
                 self.add_item(btn)
         
         # Кнопки навигации (если предметов больше, чем на одной странице)
-        if len(self.items) > ITEMS_PER_PAGE:
-            prev_btn = Button(
-                style=discord.ButtonStyle.blurple,
-                emoji="⬅️",
-                disabled=self.current_page == 0
-            )
-            prev_btn.callback = self.prev_page
-            self.add_item(prev_btn)
-            
-            page_btn = Button(
-                style=discord.ButtonStyle.gray,
-                label=f"{self.current_page+1}/{(len(self.items)+ITEMS_PER_PAGE-1)//ITEMS_PER_PAGE}",
-                disabled=True
-            )
-            self.add_item(page_btn)
-            
-            next_btn = Button(
-                style=discord.ButtonStyle.blurple,
-                emoji="➡️",
-                disabled=(self.current_page+1)*ITEMS_PER_PAGE >= len(self.items)
-            )
-            next_btn.callback = self.next_page
-            self.add_item(next_btn)
+        if self.page_count > 1:
+            self.prev_btn.disabled = self.current_page == 0
+            self.page_btn.label = f"{self.current_page+1}/{self.page_count}"
+            self.next_btn.disabled = self.current_page + 1 >= self.page_count
+            self.add_item(self.prev_btn)
+            self.add_item(self.page_btn)
+            self.add_item(self.next_btn)
 
     async def prev_page(self, interaction):
         """Переход на предыдущую страницу"""
-        self.current_page -= 1
-        self.update_buttons()
+        if not await admit(interaction, 'inventory'):
+            return
+        self.current_page = max(0, self.current_page - 1)
+        self.load_page()
         await self.update_message(interaction)
 
     async def next_page(self, interaction):
         """Переход на следующую страницу"""
+        if not await admit(interaction, 'inventory'):
+            return
         self.current_page += 1
-        self.update_buttons()
+        self.load_page()
         await self.update_message(interaction)
 
     async def update_message(self, interaction):
-        """Обновляет сообщение с новым embed"""
-        embed = self.create_embed()
-        await interaction.response.edit_message(embed=embed, view=self)
+        """Обновляет сообщение с новым embed (частые нажатия склеиваются)"""
+        await coalescer.edit(interaction, lambda: {'embed': self.create_embed(), 'view': self})
+
+    async def on_timeout(self):
+        # Индекс нужен только открытым просмотрам
+        inventory_index.pop((self.server_id, self.user_id), None)
 
     def create_embed(self):
         """Создает embed для отображения инвентаря"""
@@ -161,48 +1764,65 @@ class InventoryView(View):
         )
         
         start_idx = self.current_page * ITEMS_PER_PAGE
-        end_idx = start_idx + ITEMS_PER_PAGE
         
-        for i, item in enumerate(self.items[start_idx:end_idx], start_idx + 1):
+        role_mentions = guild_cache.item_roles(self.ctx.guild)
+        for i, (item, count) in enumerate(self.page_items, start_idx + 1):
             # Проверяем тип предмета
             if item in ITEM_CURRENCY_REWARDS:
                 rewards = ITEM_CURRENCY_REWARDS[item]
                 desc = "Дает валюту: " + ", ".join([f"{amt} {CURRENCIES[curr]}" for curr, amt in rewards.items()])
             elif item in ITEM_ROLES:
-                role = self.ctx.guild.get_role(ITEM_ROLES[item])
-                desc = f"Дает роль: {role.mention}" if role else "Дает роль (не найдена)"
+                mention = role_mentions[item]
+                desc = f"Дает роль: {mention}" if mention else "Дает роль (не найдена)"
             else:
                 desc = "Нельзя использовать"
             
             embed.add_field(
-                name=f"#{i}: {item}",
+                name=f"#{i}: {item} ×{count}" if count > 1 else f"#{i}: {item}",
                 value=desc,
                 inline=False
             )
         
-        embed.set_footer(text=f"Страница {self.current_page+1}/{(len(self.items)+ITEMS_PER_PAGE-1)//ITEMS_PER_PAGE} | Всего: {len(self.items)}")
+        embed.set_footer(text=f"Страница {self.current_page+1}/{self.page_count} | Всего: {self.total}")
         embed.set_thumbnail(url=self.member.display_avatar.url)
         return embed
 
-    async def use_item(self, interaction, item_idx, item):
-        """Обработка использования предмета"""
+    @staticmethod
+    def slot_id(slot: int, item: str) -> str:
+        """custom_id кнопки: позиция и короткая метка предмета (название может не влезть в 100 символов)"""
+        return f"use_{slot}_{hashlib.blake2s(item.encode(), digest_size=8).hexdigest()}"
+
+    async def use_slot(self, interaction, slot: int):
+        """Нажатие кнопки использования: предмет определяется по позиции на текущей странице.
+        Страница меняется сразу, а сообщение обновляется с задержкой, поэтому нажатие на кнопку
+        старой страницы отклоняется, если в этой позиции теперь другой предмет"""
+        if slot >= len(self.page_items):
+            return await interaction.response.send_message("❌ Предмет не найден!", ephemeral=True)
+        item, _ = self.page_items[slot]
+        if (interaction.data or {}).get('custom_id') != self.slot_id(slot, item):
+            return await interaction.response.send_message(
+                "❌ Страница инвентаря изменилась, нажмите кнопку еще раз", ephemeral=True)
+        key = f"use:{interaction.message.id}:{self.uses}:{item}"
+        if not await claim_operation(interaction, key):
+            return
+        if await self.use_item(interaction, self.current_page * ITEMS_PER_PAGE + slot, item):
+            self.uses += 1
+        else:
+            operations.release(key)
+
+    async def use_item(self, interaction, item_idx, item) -> bool:
+        """Обработка использования предмета; возвращает True, если предмет израсходован"""
         try:
             # Проверяем, дает ли предмет валюту
             if item in ITEM_CURRENCY_REWARDS:
                 server_id = str(interaction.guild.id)
                 user_id = str(interaction.user.id)
                 
-                # Добавляем валюту
-                for currency, amount in ITEM_CURRENCY_REWARDS[item].items():
-                    CurrencySystem.update_balance(server_id, user_id, currency, amount)
-                
-                # Обновляем инвентарь
-                inventory = load_data(INVENTORY_FILE)
-                if (server_id in inventory and 
-                    user_id in inventory[server_id] and 
-                    item in inventory[server_id][user_id]):
-                    inventory[server_id][user_id].remove(item)
-                    save_data(inventory, INVENTORY_FILE)
+                # Сначала забираем предмет, затем начисляем валюту
+                if remove_from_inventory(server_id, user_id, item):
+                    CurrencySystem.apply_batch(server_id, [
+                        (user_id, currency, amount) for currency, amount in ITEM_CURRENCY_REWARDS[item].items()
+                    ])
                     
                     reward_text = ", ".join([f"{amount} {CURRENCIES[currency]}" 
                                           for currency, amount in ITEM_CURRENCY_REWARDS[item].items()])
@@ -213,31 +1833,25 @@ class InventoryView(View):
                     )
                     await interaction.response.send_message(embed=embed, ephemeral=True)
                     
-                    self.items = inventory[server_id][user_id]
+                    self.load_page()
                     embed = self.create_embed()
                     await interaction.followup.edit_message(interaction.message.id, embed=embed, view=self)
-                    return
+                    return True
             
             # Проверяем, дает ли предмет роль
             if item in ITEM_ROLES:
                 role = interaction.guild.get_role(ITEM_ROLES[item])
                 if not role:
                     await interaction.response.send_message("❌ Роль не найдена!", ephemeral=True)
-                    return
+                    return False
                 
                 await self.member.add_roles(role)
                 
                 # Обновляем инвентарь
-                inventory = load_data(INVENTORY_FILE)
                 server_id = str(interaction.guild.id)
                 user_id = str(self.member.id)
                 
-                if (server_id in inventory and 
-                    user_id in inventory[server_id] and 
-                    item in inventory[server_id][user_id]):
-                    inventory[server_id][user_id].remove(item)
-                    save_data(inventory, INVENTORY_FILE)
-                    
+                if remove_from_inventory(server_id, user_id, item):
                     embed = discord.Embed(
                         title="🎉 Предмет использован",
                         description=f"Вы получили роль {role.mention}!",
@@ -245,33 +1859,33 @@ class InventoryView(View):
                     )
                     await interaction.response.send_message(embed=embed, ephemeral=True)
                     
-                    self.items = inventory[server_id][user_id]
+                    self.load_page()
                     embed = self.create_embed()
                     await interaction.followup.edit_message(interaction.message.id, embed=embed, view=self)
-                    return
+                    return True
             
             # Если предмет нельзя использовать
             if not interaction.response.is_done():
                 await interaction.response.send_message("❌ Этот предмет нельзя использовать!", ephemeral=True)
+            return False
         
         except Exception as e:
             if not interaction.response.is_done():
                 await interaction.response.send_message(f"❌ Ошибка: {str(e)}", ephemeral=True)
-            else:
-                await interaction.followup.send(f"❌ Ошибка: {str(e)}", ephemeral=True)
+                return False
+            # Ответ уже отправлен - предмет израсходован, ошибка была при обновлении сообщения
+            await interaction.followup.send(f"❌ Ошибка: {str(e)}", ephemeral=True)
+            return True
 
 # --- Команды инвентаря ---
 @bot.command(name="инвентарь")
 async def show_inventory(ctx, member: Optional[discord.Member] = None):
     """Просмотреть инвентарь"""
     member = member or ctx.author
-    inventory = load_data(INVENTORY_FILE)
     server_id = str(ctx.guild.id)
     user_id = str(member.id)
     
-    items = inventory.get(server_id, {}).get(user_id, [])
-    
-    if not items:
+    if not get_inventory(server_id, user_id):
         embed = discord.Embed(
             title=f"📦 Инвентарь {member.display_name}",
             description="Инвентарь пуст!",
@@ -279,7 +1893,7 @@ async def show_inventory(ctx, member: Optional[discord.Member] = None):
         )
         return await ctx.send(embed=embed)
     
-    view = InventoryView(ctx, member, items)
+    view = InventoryView(ctx, member)
     embed = view.create_embed()
     await ctx.send(embed=embed, view=view)
 
@@ -291,17 +1905,10 @@ async def add_item(ctx, member: Optional[discord.Member] = None, *, item: str =
         return await ctx.send("❌ Укажите предмет для добавления!")
     
     member = member or ctx.author
-    inventory = load_data(INVENTORY_FILE)
     server_id = str(ctx.guild.id)
     user_id = str(member.id)
     
-    if server_id not in inventory:
-        inventory[server_id] = {}
-    if user_id not in inventory[server_id]:
-        inventory[server_id][user_id] = []
-    
-    inventory[server_id][user_id].append(item)
-    save_data(inventory, INVENTORY_FILE)
+    add_to_inventory(server_id, user_id, item)
     
     embed = discord.Embed(
         title="✅ Предмет добавлен",
@@ -318,18 +1925,12 @@ async def remove_item(ctx, member: Optional[discord.Member] = None, *, item: str
         return await ctx.send("❌ Укажите предмет для удаления!")
     
     member = member or ctx.author
-    inventory = load_data(INVENTORY_FILE)
     server_id = str(ctx.guild.id)
     user_id = str(member.id)
     
-    if (server_id not in inventory or 
-        user_id not in inventory[server_id] or 
-        item not in inventory[server_id][user_id]):
+    if not remove_from_inventory(server_id, user_id, item):
         return await ctx.send("❌ Предмет не найден в инвентаре!")
     
-    inventory[server_id][user_id].remove(item)
-    save_data(inventory, INVENTORY_FILE)
-    
     embed = discord.Embed(
         title="🗑️ Предмет удален",
         description=f"Предмет {item} удален у {member.mention}",
@@ -343,19 +1944,14 @@ async def remove_item(ctx, member: Optional[discord.Member] = None, *, item: str
 async def clear_inventory(ctx, member: Optional[discord.Member] = None):
     """Очистить инвентарь пользователя (только для админов)"""
     member = member or ctx.author
-    inventory = load_data(INVENTORY_FILE)
     server_id = str(ctx.guild.id)
     user_id = str(member.id)
     
-    if server_id not in inventory or user_id not in inventory[server_id]:
+    if user_id not in store.partition(INVENTORY_FILE, server_id, create=False):
         return await ctx.send(f"❌ Инвентарь {member.mention} уже пуст!")
     
-    # Сохраняем количество удаленных предметов для сообщения
-    items_count = len(inventory[server_id][user_id])
-    
-    # Очищаем инвентарь
-    inventory[server_id][user_id] = []
-    save_data(inventory, INVENTORY_FILE)
+    # Очищаем инвентарь и сохраняем количество удаленных предметов для сообщения
+    items_count = clear_user_inventory(server_id, user_id)
     
     embed = discord.Embed(
         title="🗑️ Инвентарь очищен",
@@ -367,6 +1963,10 @@ async def clear_inventory(ctx, member: Optional[discord.Member] = None):
 @bot.command(name="команды")
 async def show_commands(ctx):
     """Показать все доступные команды"""
+    await ctx.send(embed=embed_cache.get('commands', None, build_commands_embed))
+
+def build_commands_embed() -> discord.Embed:
+    """Справка по командам (одинакова для всех серверов)"""
     embed = discord.Embed(
         title="📜 Список всех команд",
         description="Доступные команды бота:",
@@ -397,6 +1997,7 @@ async def show_commands(ctx):
             "`+забратьвалюту [@игрок] [валюта] <сумма>` - Забрать валюту (админ)"
             "`+перевод [@игрок] <валюта> <сумма>` - Перевести валюту\n"
             "`+топвалюты [валюта]` - Топ игроков по валюте\n"
+            "`+историявалюты [@игрок]` - Последние движения валюты (админ)\n"
             "`+стартоваявалюта [@игрок]` - Выдача стартовых денег"
         ),
         inline=False
@@ -408,7 +2009,7 @@ async def show_commands(ctx):
             "`+добавитькейс <название> <валюта> <стоимость> <предметы>` - Добавить кейс (админ)\n"
             "`+удалитькейс <название>` - Удалить кейс (админ)\n"
             "`+списоккейсов` - Показать все кейсы\n"
-            "`+открытькейс <название>` - Открыть кейс\n"
+            "`+открытькейс <название> [количество]` - Открыть кейс (или сразу несколько)\n"
             "`+установитьцену <название> <валюта> <стоимость>` - Изменить цену кейса\n"
             "Формат предметов: \"Предмет1:50, Предмет2:30\""
         ),
@@ -437,8 +2038,7 @@ async def show_commands(ctx):
         text="Доступные валюты: " + ", ".join(CURRENCIES.keys()) + 
         "\nПример: +добавитьвалюту @Игрок Рубли 100"
     )
-    
-    await ctx.send(embed=embed)
+    return embed
 
 @bot.command(name="ролевые_предметы", aliases=["рп", "role_items"])
 async def show_role_items(ctx):
@@ -446,7 +2046,42 @@ async def show_role_items(ctx):
     if not ITEM_ROLES and not ITEM_CURRENCY_REWARDS:
         return await ctx.send("❌ Нет полезных предметов в системе!")
     
-    # Создаем embed с пагинацией
+    pages = embed_cache.get('role_items', ctx.guild.id, lambda: build_role_item_pages(ctx.guild))
+    
+    # Отправляем первую страницу
+    message = await ctx.send(embed=pages[0])
+    
+    # Добавляем кнопки навигации если страниц больше 1
+    if len(pages) > 1:
+        current_page = 0
+        view = View(timeout=60)
+        
+        # Кнопка "Назад"
+        prev_button = Button(style=discord.ButtonStyle.blurple, emoji="⬅️")
+        async def prev_callback(interaction):
+            nonlocal current_page
+            if not await admit(interaction, 'role_items'):
+                return
+            current_page = max(0, current_page - 1)
+            await coalescer.edit(interaction, lambda: {'embed': pages[current_page]})
+        prev_button.callback = prev_callback
+        
+        # Кнопка "Вперед"
+        next_button = Button(style=discord.ButtonStyle.blurple, emoji="➡️")
+        async def next_callback(interaction):
+            nonlocal current_page
+            if not await admit(interaction, 'role_items'):
+                return
+            current_page = min(len(pages)-1, current_page + 1)
+            await coalescer.edit(interaction, lambda: {'embed': pages[current_page]})
+        next_button.callback = next_callback
+        
+        view.add_item(prev_button)
+        view.add_item(next_button)
+        await message.edit(view=view)
+
+def build_role_item_pages(guild) -> List[discord.Embed]:
+    """Страницы +рп: предметы, дающие роли (упоминания зависят от сервера) и валюту"""
     items_per_page = 5
     pages = []
     
@@ -454,9 +2089,9 @@ async def show_role_items(ctx):
     all_items = []
     
     # Предметы с ролями
+    role_mentions = guild_cache.item_roles(guild)
     for item_name, role_id in ITEM_ROLES.items():
-        role = ctx.guild.get_role(role_id)
-        role_name = role.mention if role else f"❌ Роль (ID: {role_id}) не найдена"
+        role_name = role_mentions[item_name] or f"❌ Роль (ID: {role_id}) не найдена"
         all_items.append((item_name, f"Дает роль: {role_name}"))
     
     # Предметы с валютой
@@ -483,34 +2118,61 @@ async def show_role_items(ctx):
         
         embed.set_footer(text=f"Страница {len(pages)+1}/{(len(all_items)+items_per_page-1)//items_per_page}")
         pages.append(embed)
-    
-    # Отправляем первую страницу
-    message = await ctx.send(embed=pages[0])
-    
-    # Добавляем кнопки навигации если страниц больше 1
-    if len(pages) > 1:
-        current_page = 0
-        view = View(timeout=60)
-        
-        # Кнопка "Назад"
-        prev_button = Button(style=discord.ButtonStyle.blurple, emoji="⬅️")
-        async def prev_callback(interaction):
-            nonlocal current_page
-            current_page = max(0, current_page - 1)
-            await interaction.response.edit_message(embed=pages[current_page])
-        prev_button.callback = prev_callback
-        
-        # Кнопка "Вперед"
-        next_button = Button(style=discord.ButtonStyle.blurple, emoji="➡️")
-        async def next_callback(interaction):
-            nonlocal current_page
-            current_page = min(len(pages)-1, current_page + 1)
-            await interaction.response.edit_message(embed=pages[current_page])
-        next_button.callback = next_callback
-        
-        view.add_item(prev_button)
-        view.add_item(next_button)
-        await message.edit(view=view)
+    return pages
+
+# --- Индекс лидеров ---
+class Leaderboard:
+    """Отсортированный индекс балансов одного сервера по одной валюте.
+    Обновляется точечно (двоичный поиск), топ читается с начала за O(K)"""
+
+    def __init__(self, balances: Dict[str, int]):
+        self.amounts = dict(balances)
+        self.entries = sorted((-amount, user_id) for user_id, amount in self.amounts.items())
+
+    def update(self, user_id: str, amount: int):
+        old = self.amounts.get(user_id)
+        if old == amount:
+            return
+        if old is not None:
+            del self.entries[bisect.bisect_left(self.entries, (-old, user_id))]
+        self.amounts[user_id] = amount
+        bisect.insort(self.entries, (-amount, user_id))
+
+    def top(self):
+        """Перебирает (user_id, баланс) по убыванию баланса"""
+        for amount, user_id in self.entries:
+            yield user_id, -amount
+
+class LeaderboardIndex:
+    """Индексы лидеров по (файл, сервер, валюта); строятся при первом запросе
+    и дальше поддерживаются каждым изменением баланса"""
+
+    def __init__(self):
+        self.boards: Dict[Tuple[str, str, Optional[str]], Leaderboard] = {}
+
+    def get(self, filename: str, server_id: str, currency: Optional[str] = None) -> Leaderboard:
+        key = (filename, server_id, currency)
+        if key not in self.boards:
+            partition = store.partition(filename, server_id, create=False)
+            if currency is None:
+                balances = partition
+            else:
+                balances = {user_id: currencies[currency] for user_id, currencies in partition.items()
+                            if currency in currencies}
+            self.boards[key] = Leaderboard(balances)
+        return self.boards[key]
+
+    def update(self, filename: str, server_id: str, currency: Optional[str], user_id: str, amount: int):
+        board = self.boards.get((filename, server_id, currency))
+        if board is not None:
+            board.update(user_id, amount)
+
+    def invalidate(self, filename: str, server_id: Optional[str] = None):
+        """Сбрасывает индексы файла (или одного сервера) после массовой замены данных"""
+        for key in [key for key in self.boards if key[0] == filename and server_id in (None, key[1])]:
+            del self.boards[key]
+
+leaderboards = LeaderboardIndex()
 
 # Файл для хранения валюты
 CURRENCY_FILE = 'currency.json'
@@ -525,37 +2187,80 @@ CURRENCIES = {
 class CurrencySystem:
     @staticmethod
     def load_currency() -> Dict[str, Dict[str, Dict[str, int]]]:
-        """Загружает данные о валюте из файла"""
-        if not os.path.exists(CURRENCY_FILE):
-            return {}
-        with open(CURRENCY_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        """Возвращает данные о валюте из резидентного хранилища"""
+        return store.load(CURRENCY_FILE)
 
     @staticmethod
     def save_currency(data: Dict[str, Dict[str, Dict[str, int]]]):
-        """Сохраняет данные о валюте в файл"""
-        with open(CURRENCY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        """Заменяет данные о валюте целиком"""
+        store.replace(CURRENCY_FILE, data)
+        leaderboards.invalidate(CURRENCY_FILE)
 
     @staticmethod
     def get_balance(server_id: str, user_id: str, currency: str) -> int:
         """Получает баланс пользователя по валюте"""
-        data = CurrencySystem.load_currency()
-        return data.get(server_id, {}).get(user_id, {}).get(currency, 0)
+        return store.partition(CURRENCY_FILE, server_id, create=False).get(user_id, {}).get(currency, 0)
 
     @staticmethod
     def update_balance(server_id: str, user_id: str, currency: str, amount: int):
         """Обновляет баланс пользователя"""
-        data = CurrencySystem.load_currency()
+        balances = store.partition(CURRENCY_FILE, server_id).setdefault(user_id, {})
+        current = balances.get(currency, 0)
+        balances[currency] = max(0, current + amount)
+        if store.ledger:
+            store.ledger.note(server_id, user_id, currency, balances[currency] - current)
+        store.mark_dirty(CURRENCY_FILE, server_id, user_id)
+        leaderboards.update(CURRENCY_FILE, server_id, currency, user_id, balances[currency])
+
+    @staticmethod
+    def apply_batch(server_id: str, changes: List[Tuple[str, str, int]]) -> bool:
+        """Атомарно применяет набор изменений [(user_id, валюта, сумма), ...]
+        Если хотя бы один баланс ушел бы в минус, не применяется ничего и возвращается False"""
+        partition = store.partition(CURRENCY_FILE, server_id, create=False)
         
-        if server_id not in data:
-            data[server_id] = {}
-        if user_id not in data[server_id]:
-            data[server_id][user_id] = {}
+        # Сначала считаем итоговые балансы, не трогая данные
+        results: Dict[Tuple[str, str], int] = {}
+        for user_id, currency, amount in changes:
+            key = (user_id, currency)
+            if key not in results:
+                results[key] = partition.get(user_id, {}).get(currency, 0)
+            results[key] += amount
+        if any(balance < 0 for balance in results.values()):
+            return False
         
-        current = data[server_id][user_id].get(currency, 0)
-        data[server_id][user_id][currency] = max(0, current + amount)
-        CurrencySystem.save_currency(data)
+        # Все проверки пройдены - применяем изменения одним проходом
+        partition = store.partition(CURRENCY_FILE, server_id)
+        for (user_id, currency), balance in results.items():
+            balances = partition.setdefault(user_id, {})
+            if store.ledger:
+                store.ledger.note(server_id, user_id, currency, balance - balances.get(currency, 0))
+            balances[currency] = balance
+            store.mark_dirty(CURRENCY_FILE, server_id, user_id)
+            leaderboards.update(CURRENCY_FILE, server_id, currency, user_id, balance)
+        return True
+
+    @staticmethod
+    def apply_rates(server_id: str, rates: Dict[str, float], threshold: int = 0) -> int:
+        """Меняет все балансы сервера на rates[валюта] процентов от суммы выше threshold
+        (отрицательный процент - списание). Возвращает число затронутых игроков"""
+        partition = store.partition(CURRENCY_FILE, server_id, create=False)
+        changed = []
+        for user_id, balances in partition.items():
+            touched = False
+            for currency, rate in rates.items():
+                balance = balances.get(currency, 0)
+                delta = int((balance - threshold) * rate / 100)
+                if balance <= threshold or delta == 0:
+                    continue
+                balances[currency] = max(0, balance + delta)
+                if store.ledger:
+                    store.ledger.note(server_id, user_id, currency, balances[currency] - balance)
+                leaderboards.update(CURRENCY_FILE, server_id, currency, user_id, balances[currency])
+                touched = True
+            if touched:
+                changed.append(user_id)
+        store.mark_dirty_many(CURRENCY_FILE, server_id, changed)
+        return len(changed)
 
 # Команды для работы с валютой
 @bot.command(name="баланс")
@@ -622,13 +2327,15 @@ async def remove_currency(ctx, member: discord.Member, currency: str, amount: in
     server_id = str(ctx.guild.id)
     user_id = str(member.id)
     
-    # Проверка баланса игрока
-    current_balance = CurrencySystem.get_balance(server_id, user_id, currency)
-    if current_balance < amount:
-        return await ctx.send(f"❌ У игрока недостаточно средств! Текущий баланс: {current_balance} {CURRENCIES[currency]}")
-    
-    # Забираем валюту
-    CurrencySystem.update_balance(server_id, user_id, currency, -amount)
+    async with user_locks.acquire(server_id, user_id):
+        # Проверка баланса игрока
+        current_balance = CurrencySystem.get_balance(server_id, user_id, currency)
+        if current_balance < amount:
+            return await ctx.send(f"❌ У игрока недостаточно средств! Текущий баланс: {current_balance} {CURRENCIES[currency]}")
+        
+        # Забираем валюту
+        CurrencySystem.apply_batch(server_id, [(user_id, currency, -amount)])
+        new_balance = CurrencySystem.get_balance(server_id, user_id, currency)
     
     embed = discord.Embed(
         title="💰 Валюта изъята",
@@ -637,7 +2344,7 @@ async def remove_currency(ctx, member: discord.Member, currency: str, amount: in
     )
     embed.add_field(
         name="Новый баланс",
-        value=f"{CurrencySystem.get_balance(server_id, user_id, currency)} {CURRENCIES[currency]}",
+        value=f"{new_balance} {CURRENCIES[currency]}",
         inline=False
     )
     embed.set_thumbnail(url=member.display_avatar.url)
@@ -657,14 +2364,18 @@ async def transfer(ctx, member: discord.Member, currency: str, amount: int):
     sender_id = str(ctx.author.id)
     receiver_id = str(member.id)
     
-    # Проверка баланса отправителя
-    sender_balance = CurrencySystem.get_balance(server_id, sender_id, currency)
-    if sender_balance < amount:
-        return await ctx.send("❌ Недостаточно средств для перевода!")
-    
-    # Выполнение перевода
-    CurrencySystem.update_balance(server_id, sender_id, currency, -amount)
-    CurrencySystem.update_balance(server_id, receiver_id, currency, amount)
+    async with user_locks.acquire(server_id, sender_id, receiver_id):
+        # Проверка баланса отправителя
+        sender_balance = CurrencySystem.get_balance(server_id, sender_id, currency)
+        if sender_balance < amount:
+            return await ctx.send("❌ Недостаточно средств для перевода!")
+        
+        # Выполнение перевода
+        if not CurrencySystem.apply_batch(server_id, [
+            (sender_id, currency, -amount),
+            (receiver_id, currency, amount)
+        ]):
+            return await ctx.send("❌ Недостаточно средств для перевода!")
     
     embed = discord.Embed(
         title="💸 Перевод выполнен",
@@ -679,18 +2390,14 @@ async def currency_top(ctx, currency: str = "Рубли"):
     if currency not in CURRENCIES:
         return await ctx.send(f"❌ Доступные валюты: {', '.join(CURRENCIES.keys())}")
     
-    data = CurrencySystem.load_currency()
-    server_data = data.get(str(ctx.guild.id), {})
-    
-    # Сбор и сортировка данных
+    # Берем лидеров из индекса, пропуская ушедших с сервера
     top_players = []
-    for user_id, currencies in server_data.items():
-        if currency in currencies:
-            member = ctx.guild.get_member(int(user_id))
-            if member:
-                top_players.append((member.display_name, currencies[currency]))
-    
-    top_players.sort(key=lambda x: x[1], reverse=True)
+    for user_id, amount in leaderboards.get(CURRENCY_FILE, str(ctx.guild.id), currency).top():
+        name = guild_cache.display_name(ctx.guild, int(user_id))
+        if name:
+            top_players.append((name, amount))
+            if len(top_players) == 10:
+                break
     
     # Формирование embed
     embed = discord.Embed(
@@ -707,6 +2414,27 @@ async def currency_top(ctx, currency: str = "Рубли"):
     
     await ctx.send(embed=embed)
 
+@bot.command(name="историявалюты")
+@commands.has_permissions(administrator=True)
+async def currency_history(ctx, member: Optional[discord.Member] = None):
+    """Последние движения валюты игрока из журнала (только для админов)"""
+    if not store.ledger:
+        return await ctx.send("❌ Журнал движений валюты отключен (CURRENCY_LEDGER=0)")
+    
+    target = member or ctx.author
+    entries = await store.io.run(LEDGER_DIR, store.ledger.history, str(ctx.guild.id), str(target.id))
+    if not entries:
+        return await ctx.send(f"ℹ️ У {target.display_name} нет движений валюты")
+    
+    lines = [f"<t:{int(timestamp)}:f> {amount:+} {CURRENCIES.get(currency, '')} {currency} - {reason}"
+             for timestamp, currency, amount, reason in reversed(entries)]
+    embed = discord.Embed(
+        title=f"📒 Движения валюты {target.display_name}",
+        description="\n".join(lines),
+        color=discord.Color.blue()
+    )
+    await ctx.send(embed=embed)
+
 @bot.command(name='выпадение')
 async def drop_check(ctx, chance: int, *, item_name: str):
     """Проверить выпадение предмета
@@ -752,6 +2480,7 @@ async def drop_check(ctx, chance: int, *, item_name: str):
 @bot.event
 async def on_member_join(member):
     """Выдаем стартовую валюту новому участнику"""
+    guild_cache.invalidate_member(member.guild.id, member.id)
     server_id = str(member.guild.id)
     user_id = str(member.id)
     
@@ -761,8 +2490,9 @@ async def on_member_join(member):
         return  # У пользователя уже есть записи о валюте
     
     # Выдаем стартовую валюту
-    for currency, amount in STARTING_CURRENCY.items():
-        CurrencySystem.update_balance(server_id, user_id, currency, amount)
+    CurrencySystem.apply_batch(server_id, [
+        (user_id, currency, amount) for currency, amount in STARTING_CURRENCY.items()
+    ])
     
     # Можно добавить лог в консоль
     print(f"Выдана стартовая валюта новому участнику: {member.display_name}")
@@ -785,8 +2515,9 @@ async def give_starting_currency(ctx, member: Optional[discord.Member] = None):
                 return await ctx.send(f"❌ {member.mention} уже получал стартовую валюту!")
     
     # Выдаем стартовую валюту
-    for currency, amount in STARTING_CURRENCY.items():
-        CurrencySystem.update_balance(server_id, user_id, currency, amount)
+    CurrencySystem.apply_batch(server_id, [
+        (user_id, currency, amount) for currency, amount in STARTING_CURRENCY.items()
+    ])
     
     embed = discord.Embed(
         title="💰 Стартовая валюта выдана",
@@ -803,44 +2534,113 @@ async def give_starting_currency(ctx, member: Optional[discord.Member] = None):
     
     await ctx.send(embed=embed)
 
+class AliasSampler:
+    """Таблица псевдонимов (метод Уолкера-Воуза): выбор предмета по весам за O(1)"""
+
+    def __init__(self, items: List[dict]):
+        self.items = [item['item'] for item in items]
+        count = len(items)
+        total = sum(item['chance'] for item in items)
+        scaled = [item['chance'] * count / total for item in items]
+        self.prob = [1.0] * count
+        self.alias = list(range(count))
+
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+        # Оставшиеся из-за погрешности округления ячейки выбираются с вероятностью 1
+
+    def sample(self) -> str:
+        i = int(random.random() * len(self.items))
+        return self.items[i] if random.random() < self.prob[i] else self.items[self.alias[i]]
+
+    def sample_many(self, count: int) -> List[str]:
+        """Разыгрывает count предметов за один проход (одно случайное число на предмет:
+        целая часть выбирает ячейку, дробная - между ней и ее псевдонимом)"""
+        items, prob, alias, size = self.items, self.prob, self.alias, len(self.items)
+        result = []
+        for _ in range(count):
+            roll = random.random() * size
+            i = int(roll)
+            result.append(items[i] if roll - i < prob[i] else items[alias[i]])
+        return result
+
 # Класс для работы с кейсами
 class CaseSystem:
+    samplers: Dict[str, AliasSampler] = {}  # Скомпилированные таблицы выпадения по названию кейса
+    names: Optional[List[str]] = None  # Индекс названий кейсов для постраничного каталога
+    pages: Optional[List[List[str]]] = None  # Названия кейсов по страницам каталога
+
+    @staticmethod
+    def invalidate(case_name=None):
+        """Сбрасывает производные данные после изменения кейсов (None - всех кейсов)"""
+        if case_name is None:
+            CaseSystem.samplers.clear()
+        else:
+            CaseSystem.samplers.pop(case_name, None)
+        CaseSystem.names = None
+        CaseSystem.pages = None
+        embed_cache.bump('cases')
+
+    @staticmethod
+    def case_names() -> List[str]:
+        """Названия всех кейсов в порядке добавления"""
+        if CaseSystem.names is None:
+            CaseSystem.names = list(CaseSystem.load_cases())
+        return CaseSystem.names
+
+    @staticmethod
+    def case_pages() -> List[List[str]]:
+        """Разбивка каталога на страницы: не больше CASES_PER_PAGE кейсов и не длиннее
+        EMBED_TOTAL_LIMIT символов (кейс, который не помещается, переносится на следующую)"""
+        if CaseSystem.pages is None:
+            cases = CaseSystem.load_cases()
+            budget = EMBED_TOTAL_LIMIT - 100  # Запас под заголовок и подпись страницы
+            pages = [[]]
+            length = 0
+            for case_name in CaseSystem.case_names():
+                name, value = case_field(case_name, cases[case_name])
+                size = len(name) + len(value)
+                if pages[-1] and (len(pages[-1]) == CASES_PER_PAGE or length + size > budget):
+                    pages.append([])
+                    length = 0
+                pages[-1].append(case_name)
+                length += size
+            CaseSystem.pages = pages
+        return CaseSystem.pages
+
     @staticmethod
     def load_cases():
-        """Загружает кейсы из файла"""
-        if not os.path.exists(CASES_FILE):
-            return {}
+        """Возвращает кейсы из резидентного хранилища"""
+        data = store.load(CASES_FILE)
         
-        try:
-            with open(CASES_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-                # Конвертируем старый формат в новый, если необходимо
-                if isinstance(data, list):
-                    new_data = {}
-                    for case in data:
-                        if isinstance(case, dict) and "name" in case and "items" in case:
-                            new_data[case["name"]] = {
-                                "items": case["items"],
-                                "price": {
-                                    "currency": None,
-                                    "amount": 0
-                                }
-                            }
-                    if new_data:
-                        CaseSystem.save_cases(new_data)
-                        return new_data
-                    return {}
-                
-                return data
-        except:
-            return {}
+        # Конвертируем старый формат в новый, если необходимо
+        if isinstance(data, list):
+            new_data = {}
+            for case in data:
+                if isinstance(case, dict) and "name" in case and "items" in case:
+                    new_data[case["name"]] = {
+                        "items": case["items"],
+                        "price": {
+                            "currency": None,
+                            "amount": 0
+                        }
+                    }
+            CaseSystem.save_cases(new_data)
+            return new_data
+        
+        return data
 
     @staticmethod
     def save_cases(data):
-        """Сохраняет кейсы в файл"""
-        with open(CASES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        """Заменяет кейсы целиком"""
+        store.replace(CASES_FILE, data)
+        CaseSystem.invalidate()
 
     @staticmethod
     def add_case(case_name, items, price_currency=None, price_amount=0):
@@ -853,7 +2653,8 @@ class CaseSystem:
                 "amount": price_amount
             }
         }
-        CaseSystem.save_cases(cases)
+        store.mark_dirty(CASES_FILE, case_name)
+        CaseSystem.invalidate(case_name)
 
     @staticmethod
     def remove_case(case_name):
@@ -861,30 +2662,30 @@ class CaseSystem:
         cases = CaseSystem.load_cases()
         if case_name in cases:
             del cases[case_name]
-            CaseSystem.save_cases(cases)
+            store.mark_dirty(CASES_FILE, case_name)
+            CaseSystem.invalidate(case_name)
             return True
         return False
 
+    @staticmethod
+    def get_sampler(case_name) -> Optional[AliasSampler]:
+        """Возвращает скомпилированную таблицу выпадения кейса (строится один раз)"""
+        sampler = CaseSystem.samplers.get(case_name)
+        if sampler is None:
+            case_data = CaseSystem.load_cases().get(case_name)
+            if case_data is None:
+                return None
+            items = case_data.get("items", []) if isinstance(case_data, dict) else case_data
+            if not items:
+                return None
+            sampler = CaseSystem.samplers[case_name] = AliasSampler(items)
+        return sampler
+
     @staticmethod
     def get_random_item(case_name):
         """Получает случайный предмет из кейса"""
-        cases = CaseSystem.load_cases()
-        if case_name not in cases:
-            return None
-        
-        items = cases[case_name]["items"]
-        if not items:
-            return None
-            
-        total_weight = sum(item['chance'] for item in items)
-        roll = random.uniform(0, total_weight)
-        current = 0
-        
-        for item in items:
-            current += item['chance']
-            if roll <= current:
-                return item['item']
-        return None
+        sampler = CaseSystem.get_sampler(case_name)
+        return sampler.sample() if sampler else None
 
     @staticmethod
     def set_case_price(case_name, currency, amount):
@@ -897,8 +2698,28 @@ class CaseSystem:
             "currency": currency,
             "amount": amount
         }
-        CaseSystem.save_cases(cases)
+        store.mark_dirty(CASES_FILE, case_name)
+        CaseSystem.invalidate(case_name)
+        return True
+
+async def reload_global_files():
+    """Перечитывает общие файлы, которые пишет процесс шарда 0 (в остальных процессах)"""
+    while not bot.is_closed():
+        await asyncio.sleep(GLOBAL_RELOAD_INTERVAL)
+        try:
+            if await store.reload(CASES_FILE):
+                CaseSystem.invalidate()
+        except Exception as e:
+            print(f"[Хранилище] Не удалось перечитать {CASES_FILE}: {str(e)}")
+
+reload_task: Optional[asyncio.Task] = None
+
+async def cases_editable(ctx) -> bool:
+    """Кейсы общие для всех шардов, поэтому изменять их может только процесс шарда 0"""
+    if owns_global_files():
         return True
+    await ctx.send("❌ Кейсы изменяются только через сервер, который обслуживает шард 0")
+    return False
 
 # Команды для работы с кейсами
 @bot.command(name='добавитькейс')
@@ -908,6 +2729,8 @@ async def add_case(ctx, case_name: str, price_currency: str = None, price_amount
     Формат: +добавитькейс НазваниеКейса [валюта] [цена] "Предмет с пробелами":50 "Другой предмет":30
     Пример: +добавитькейс Оружие Рубли 1000 "АШ-12":30 "AXMC снайперская":20
     """
+    if not await cases_editable(ctx):
+        return
     try:
         # Если цена указана, но валюта не указана
         if price_amount and not price_currency:
@@ -986,6 +2809,8 @@ async def add_case(ctx, case_name: str, price_currency: str = None, price_amount
 @commands.has_any_role(*ALLOWED_ROLE_IDS, *ADMIN_ROLE_IDS)
 async def set_case_price(ctx, case_name: str, currency: str, amount: int):
     """Установить цену кейса в валюте"""
+    if not await cases_editable(ctx):
+        return
     if currency not in CURRENCIES:
         return await ctx.send(f"❌ Неверная валюта. Доступные: {', '.join(CURRENCIES.keys())}")
     
@@ -1002,47 +2827,119 @@ async def set_case_price(ctx, case_name: str, currency: str, amount: int):
     else:
         await ctx.send(f"❌ Кейс **{case_name}** не найден!")
 
-@bot.command(name='списоккейсов')
-async def list_cases(ctx):
-    """Показать список всех кейсов с ценами"""
-    cases = CaseSystem.load_cases()
+class CaseCatalogView(View):
+    """Постраничный каталог кейсов: поля строятся только для кейсов видимой страницы"""
+
+    def __init__(self):
+        super().__init__(timeout=60)
+        self.current_page = 0
+        self.update_buttons()
+
+    def page_count(self) -> int:
+        return len(CaseSystem.case_pages())
+
+    def update_buttons(self):
+        """Обновляет кнопки навигации для текущей страницы"""
+        self.clear_items()
+        pages = self.page_count()
+        self.current_page = min(self.current_page, pages - 1)
+        if pages == 1:
+            return
+        
+        prev_btn = Button(style=discord.ButtonStyle.blurple, emoji="⬅️", disabled=self.current_page == 0)
+        prev_btn.callback = self.prev_page
+        self.add_item(prev_btn)
+        
+        page_btn = Button(style=discord.ButtonStyle.gray, label=f"{self.current_page+1}/{pages}", disabled=True)
+        self.add_item(page_btn)
+        
+        next_btn = Button(style=discord.ButtonStyle.blurple, emoji="➡️", disabled=self.current_page + 1 >= pages)
+        next_btn.callback = self.next_page
+        self.add_item(next_btn)
+
+    async def prev_page(self, interaction):
+        """Переход на предыдущую страницу"""
+        if not await admit(interaction, 'cases'):
+            return
+        self.current_page = max(0, self.current_page - 1)
+        await self.update_message(interaction)
+
+    async def next_page(self, interaction):
+        """Переход на следующую страницу"""
+        if not await admit(interaction, 'cases'):
+            return
+        self.current_page += 1
+        await self.update_message(interaction)
+
+    async def update_message(self, interaction):
+        """Обновляет сообщение с новой страницей (кейсы могли измениться с прошлого показа)"""
+        self.update_buttons()
+        await coalescer.edit(interaction, lambda: {'embed': self.create_embed(), 'view': self})
+
+    def create_embed(self) -> discord.Embed:
+        page = self.current_page
+        return embed_cache.get('cases', None, lambda: build_case_page(page), page)
+
+def case_field(case_name: str, case_data) -> Tuple[str, str]:
+    """Заголовок и описание поля одного кейса в каталоге (в пределах лимита поля)"""
+    # Проверяем структуру данных
+    if isinstance(case_data, dict):
+        items = case_data.get("items", [])
+        price_info = case_data.get("price", {"currency": None, "amount": 0})
+    else:
+        # Старый формат данных (только список предметов)
+        items = case_data
+        price_info = {"currency": None, "amount": 0}
     
-    if not cases:
-        return await ctx.send("❌ На сервере нет доступных кейсов!")
+    if price_info.get("amount", 0) > 0 and price_info.get("currency") in CURRENCIES:
+        price_text = f"{price_info['amount']} {CURRENCIES[price_info['currency']]} {price_info['currency']}"
+    else:
+        price_text = "Бесплатно"
     
+    lines = []
+    length = 0
+    for shown, item in enumerate(items):
+        line = f"• {item['item']} ({item['chance']}%)"
+        # Оставляем место под строку "...и еще N"
+        if length + len(line) + 1 > EMBED_FIELD_LIMIT - 30:
+            lines.append(f"...и еще {len(items) - shown}")
+            break
+        lines.append(line)
+        length += len(line) + 1
+    
+    return f"🔸 {case_name} - {price_text}"[:256], "\n".join(lines) if lines else "Нет предметов"
+
+def build_case_page(page: int) -> discord.Embed:
+    """Одна страница каталога кейсов (общая для всех серверов)"""
+    cases = CaseSystem.load_cases()
+    pages = CaseSystem.case_pages()
     embed = discord.Embed(
         title="📦 Доступные кейсы",
         color=discord.Color.gold()
     )
     
-    for case_name, case_data in cases.items():
-        # Проверяем структуру данных
-        if isinstance(case_data, dict):
-            items = case_data.get("items", [])
-            price_info = case_data.get("price", {"currency": None, "amount": 0})
-        else:
-            # Старый формат данных (только список предметов)
-            items = case_data
-            price_info = {"currency": None, "amount": 0}
-        
-        items_list = "\n".join(f"• {item['item']} ({item['chance']}%)" for item in items) if items else "Нет предметов"
-        
-        if price_info.get("amount", 0) > 0 and price_info.get("currency") in CURRENCIES:
-            price_text = f"{price_info['amount']} {CURRENCIES[price_info['currency']]} {price_info['currency']}"
-        else:
-            price_text = "Бесплатно"
-        
-        embed.add_field(
-            name=f"🔸 {case_name} - {price_text}",
-            value=items_list,
-            inline=False
-        )
+    for case_name in pages[min(page, len(pages) - 1)]:
+        name, value = case_field(case_name, cases[case_name])
+        embed.add_field(name=name, value=value, inline=False)
     
-    await ctx.send(embed=embed)
+    embed.set_footer(text=f"Страница {page+1}/{len(pages)} | Всего кейсов: {len(CaseSystem.case_names())}")
+    return embed
+
+@bot.command(name='списоккейсов')
+async def list_cases(ctx):
+    """Показать список всех кейсов с ценами"""
+    if not CaseSystem.case_names():
+        return await ctx.send("❌ На сервере нет доступных кейсов!")
+    
+    view = CaseCatalogView()
+    await ctx.send(embed=view.create_embed(), view=view)
+
 @bot.command(name='удалитькейс')
 @commands.has_any_role(*ALLOWED_ROLE_IDS, *ADMIN_ROLE_IDS)
 async def remove_case_command(ctx, case_name: str):
     """Удалить кейс"""
+    if not await cases_editable(ctx):
+        return
     if CaseSystem.remove_case(case_name):
         embed = discord.Embed(
             title="✅ Кейс удален",
@@ -1060,8 +2957,13 @@ async def remove_case_command(ctx, case_name: str):
 
 
 @bot.command(name='открытькейс')
-async def open_case(ctx, case_name: str):
-    """Открыть кейс (платно, если установлена цена)"""
+async def open_case(ctx, case_name: str, count: int = 1):
+    """Открыть кейс (платно, если установлена цена)
+    Пример: +открытькейс Оружие 10 - открыть сразу 10 кейсов
+    """
+    if count < 1 or count > MAX_CASES_PER_OPEN:
+        return await ctx.send(f"❌ За раз можно открыть от 1 до {MAX_CASES_PER_OPEN} кейсов!")
+    
     cases = CaseSystem.load_cases()
     
     if case_name not in cases:
@@ -1069,78 +2971,88 @@ async def open_case(ctx, case_name: str):
     
     case_data = cases[case_name]
     
-    # Обрабатываем разные форматы данных
-    if isinstance(case_data, dict):
-        items = case_data.get("items", [])
-        price_info = case_data.get("price", {"currency": None, "amount": 0})
-    else:
-        items = case_data
-        price_info = {"currency": None, "amount": 0}
-    
-    if not items:
-        return await ctx.send(f"❌ Кейс **{case_name}** пуст!")
-    
-    # Проверяем, нужно ли платить за кейс
-    if price_info.get("amount", 0) > 0 and price_info.get("currency") in CURRENCIES:
-        currency = price_info["currency"]
-        amount = price_info["amount"]
-        
-        # Проверяем баланс пользователя
-        server_id = str(ctx.guild.id)
-        user_id = str(ctx.author.id)
-        balance = CurrencySystem.get_balance(server_id, user_id, currency)
-        
-        if balance < amount:
-            return await ctx.send(
-                f"❌ Недостаточно средств! Для открытия кейса нужно {amount} {CURRENCIES[currency]} {currency}\n"
-                f"Ваш баланс: {balance} {CURRENCIES[currency]}"
-            )
-        
-        # Снимаем валюту
-        CurrencySystem.update_balance(server_id, user_id, currency, -amount)
-    
-    # Получаем случайный предмет
-    item = CaseSystem.get_random_item(case_name)
-    if not item:
-        return await ctx.send("❌ Произошла ошибка при открытии кейса!")
+    # Обрабатываем разные форматы данных
+    if isinstance(case_data, dict):
+        price_info = case_data.get("price", {"currency": None, "amount": 0})
+    else:
+        price_info = {"currency": None, "amount": 0}
+    
+    sampler = CaseSystem.get_sampler(case_name)
+    if not sampler:
+        return await ctx.send(f"❌ Кейс **{case_name}** пуст!")
     
-    # Добавляем предмет в инвентарь
-    inventory = load_data(INVENTORY_FILE)
     server_id = str(ctx.guild.id)
     user_id = str(ctx.author.id)
+    paid = price_info.get("amount", 0) > 0 and price_info.get("currency") in CURRENCIES
     
-    if server_id not in inventory:
-        inventory[server_id] = {}
-    if user_id not in inventory[server_id]:
-        inventory[server_id][user_id] = []
-    
-    inventory[server_id][user_id].append(item)
-    save_data(inventory, INVENTORY_FILE)
+    # Оплата и выдача предметов выполняются под блокировкой пользователя
+    async with user_locks.acquire(server_id, user_id):
+        # Проверяем, нужно ли платить за кейс (цена всех кейсов списывается один раз)
+        if paid:
+            currency = price_info["currency"]
+            amount = price_info["amount"] * count
+            
+            # Проверяем баланс пользователя
+            balance = CurrencySystem.get_balance(server_id, user_id, currency)
+            
+            if balance < amount:
+                return await ctx.send(
+                    f"❌ Недостаточно средств! Для открытия нужно {amount} {CURRENCIES[currency]} {currency}\n"
+                    f"Ваш баланс: {balance} {CURRENCIES[currency]}"
+                )
+            
+            # Снимаем валюту
+            CurrencySystem.apply_batch(server_id, [(user_id, currency, -amount)])
+        
+        # Разыгрываем все предметы за один проход и добавляем их одной записью
+        dropped = sampler.sample_many(count)
+        add_to_inventory(server_id, user_id, *dropped)
     
-    # Создаем красивый embed
-    embed = discord.Embed(
-        title=f"🎉 Вы открыли кейс {case_name}!",
-        description=f"Вам выпал: **{item}**",
-        color=discord.Color.gold()
-    )
+    if count == 1:
+        item = dropped[0]
+        # Создаем красивый embed
+        embed = discord.Embed(
+            title=f"🎉 Вы открыли кейс {case_name}!",
+            description=f"Вам выпал: **{item}**",
+            color=discord.Color.gold()
+        )
+    else:
+        # Один общий embed с количеством каждого предмета
+        lines = []
+        length = 0
+        for item, amount in Counter(dropped).most_common():
+            line = f"**{item}** ×{amount}"
+            if length + len(line) + 1 > 4000:
+                lines.append("…")
+                break
+            lines.append(line)
+            length += len(line) + 1
+        embed = discord.Embed(
+            title=f"🎉 Вы открыли {count} кейсов {case_name}!",
+            description="Вам выпало:\n" + "\n".join(lines),
+            color=discord.Color.gold()
+        )
     
     # Если была цена, указываем это
-    if price_info.get("amount", 0) > 0 and price_info.get("currency") in CURRENCIES:
+    if paid:
         embed.add_field(
             name="💰 Стоимость",
-            value=f"Потрачено: {price_info['amount']} {CURRENCIES[price_info['currency']]} {price_info['currency']}",
+            value=f"Потрачено: {price_info['amount'] * count} {CURRENCIES[price_info['currency']]} {price_info['currency']}",
             inline=False
         )
     
-    # Если предмет дает роль, указываем это
-    if item in ITEM_ROLES:
-        role = ctx.guild.get_role(ITEM_ROLES[item])
-        if role:
-            embed.add_field(
-                name="🔹 Особенность",
-                value=f"Этот предмет дает роль {role.mention}",
-                inline=False
-            )
+    # Если предметы дают роли, указываем это
+    role_mentions = guild_cache.item_roles(ctx.guild)
+    roles = []
+    for item in dict.fromkeys(dropped):
+        if role_mentions.get(item):
+            roles.append(role_mentions[item])
+    if roles:
+        embed.add_field(
+            name="🔹 Особенность",
+            value=f"Этот предмет дает роль {roles[0]}" if count == 1 else "Предметы дают роли: " + ", ".join(roles)[:1000],
+            inline=False
+        )
     
     embed.set_thumbnail(url="https://emojipedia-us.s3.dualstack.us-west-1.amazonaws.com/thumbs/160/twitter/282/package_1f4e6.png")
     embed.set_footer(text=f"Кейс открыл: {ctx.author.display_name}")
@@ -1163,29 +3075,23 @@ async def check_bot(ctx):
     # 1. Проверка файлов данных
     try:
         files_to_check = [INVENTORY_FILE, CURRENCY_FILE, CASES_FILE]
-        files_ok = True
         for file in files_to_check:
-            if not os.path.exists(file):
-                # Попробуем создать файл, если его нет
-                with open(file, 'w') as f:
-                    json.dump({}, f)
+            # Попробуем создать файл, если его нет (в пуле потоков, не блокируя бота)
+            await store.io.run(file, ensure_data_file, file)
+        await store.flush_async()
         checks.append("✅ Файлы данных доступны и созданы при необходимости")
     except Exception as e:
         checks.append(f"❌ Ошибка работы с файлами данных: {str(e)}")
     
     # 2. Проверка системы инвентаря
     try:
-        test_data = {"test_server": {"test_user": ["test_item"]}}
-        save_data(test_data, INVENTORY_FILE)
-        loaded = load_data(INVENTORY_FILE)
-        if loaded.get("test_server", {}).get("test_user") == ["test_item"]:
+        add_to_inventory("test_server", "test_user", "test_item")
+        if get_inventory("test_server", "test_user") == {"test_item": 1}:
             checks.append("✅ Система инвентаря работает корректно")
         else:
             checks.append("❌ Ошибка в системе инвентаря: данные не сохраняются/загружаются")
         # Удаляем тестовые данные
-        if "test_server" in loaded:
-            del loaded["test_server"]
-            save_data(loaded, INVENTORY_FILE)
+        store.delete(INVENTORY_FILE, "test_server")
     except Exception as e:
         checks.append(f"❌ Ошибка в системе инвентаря: {str(e)}")
     
@@ -1198,10 +3104,11 @@ async def check_bot(ctx):
         else:
             checks.append("❌ Ошибка в системе валюты: баланс не сохраняется")
         # Очищаем тестовые данные
-        data = CurrencySystem.load_currency()
-        if "test_server" in data:
-            del data["test_server"]
-            CurrencySystem.save_currency(data)
+        store.delete(CURRENCY_FILE, "test_server")
+        leaderboards.invalidate(CURRENCY_FILE, "test_server")
+        if store.ledger:
+            # Иначе журнал тестового сервера остался бы навсегда и читался при каждом запуске
+            await store.io.run(LEDGER_DIR, store.ledger.forget, "test_server")
     except Exception as e:
         checks.append(f"❌ Ошибка в системе валюты: {str(e)}")
     
@@ -1211,9 +3118,8 @@ async def check_bot(ctx):
             "items": [{"item": "test_item", "chance": 100}],
             "price": {"currency": "Рубли", "amount": 100}
         }
-        cases = CaseSystem.load_cases()
-        cases["test_case"] = test_case
-        CaseSystem.save_cases(cases)
+        CaseSystem.add_case("test_case", test_case["items"],
+                            test_case["price"]["currency"], test_case["price"]["amount"])
         
         loaded_cases = CaseSystem.load_cases()
         if loaded_cases.get("test_case"):
@@ -1222,9 +3128,7 @@ async def check_bot(ctx):
             checks.append("❌ Ошибка в системе кейсов: данные не сохраняются")
         
         # Удаляем тестовый кейс
-        if "test_case" in loaded_cases:
-            del loaded_cases["test_case"]
-            CaseSystem.save_cases(loaded_cases)
+        CaseSystem.remove_case("test_case")
     except Exception as e:
         checks.append(f"❌ Ошибка в системе кейсов: {str(e)}")
     
@@ -1253,29 +3157,39 @@ async def check_bot(ctx):
     
     await ctx.send(embed=embed)
 
+def paginate_lines(lines: List[str], limit: int = EMBED_DESCRIPTION_LIMIT) -> List[str]:
+    """Склеивает строки в страницы, каждая из которых не длиннее limit символов"""
+    pages = []
+    current = []
+    length = 0
+    for line in lines:
+        line = line[:limit]
+        if current and length + 1 + len(line) > limit:
+            pages.append("\n".join(current))
+            current = []
+            length = 0
+        length += len(line) + (1 if current else 0)
+        current.append(line)
+    if current:
+        pages.append("\n".join(current))
+    return pages
+
 class AdminCurrencySystem:
     @staticmethod
     def load_admin_currency() -> Dict[str, Dict[str, int]]:
-        """Загружает данные о валюте администрации из файла"""
-        if not os.path.exists(ADMIN_CURRENCY_FILE):
-            return {}
-        try:
-            with open(ADMIN_CURRENCY_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return {}
+        """Возвращает данные о валюте администрации из резидентного хранилища"""
+        return store.load(ADMIN_CURRENCY_FILE)
 
     @staticmethod
     def save_admin_currency(data: Dict[str, Dict[str, int]]):
-        """Сохраняет данные о валюте администрации в файл"""
-        with open(ADMIN_CURRENCY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        """Заменяет данные о валюте администрации целиком"""
+        store.replace(ADMIN_CURRENCY_FILE, data)
+        leaderboards.invalidate(ADMIN_CURRENCY_FILE)
 
     @staticmethod
     def get_balance(server_id: str, user_id: str) -> int:
         """Получает баланс пользователя по админ-валюте"""
-        data = AdminCurrencySystem.load_admin_currency()
-        return data.get(server_id, {}).get(user_id, 0)
+        return store.partition(ADMIN_CURRENCY_FILE, server_id, create=False).get(user_id, 0)
 
     @staticmethod
     def update_balance(server_id: str, user_id: str, amount: int):
@@ -1283,59 +3197,71 @@ class AdminCurrencySystem:
         if amount <= 0:
             return
         
-        data = AdminCurrencySystem.load_admin_currency()
-        
-        if server_id not in data:
-            data[server_id] = {}
-        if user_id not in data[server_id]:
-            data[server_id][user_id] = 0
-        
-        data[server_id][user_id] = max(0, data[server_id][user_id] + amount)
-        AdminCurrencySystem.save_admin_currency(data)
+        balances = store.partition(ADMIN_CURRENCY_FILE, server_id)
+        balances[user_id] = max(0, balances.get(user_id, 0) + amount)
+        store.mark_dirty(ADMIN_CURRENCY_FILE, server_id, user_id)
+        leaderboards.update(ADMIN_CURRENCY_FILE, server_id, None, user_id, balances[user_id])
+
+    @staticmethod
+    def apply_payouts(server_id: str, payouts: Dict[str, int]):
+        """Начисляет выплаты {user_id: сумма} одним пакетом: одна запись в журнале на весь пакет"""
+        payouts = {user_id: amount for user_id, amount in payouts.items() if amount > 0}
+        balances = store.partition(ADMIN_CURRENCY_FILE, server_id)
+        for user_id, amount in payouts.items():
+            balances[user_id] = balances.get(user_id, 0) + amount
+            leaderboards.update(ADMIN_CURRENCY_FILE, server_id, None, user_id, balances[user_id])
+        store.mark_dirty_many(ADMIN_CURRENCY_FILE, server_id, payouts)
 
     @staticmethod
     async def process_daily_payout(guild: discord.Guild):
-        """Обработка ежедневной выплаты админ-валюты"""
-        global next_daily_payout
-        
-        # Проверяем, нужно ли делать выплату
-        now = datetime.datetime.now()
-        if next_daily_payout and now < next_daily_payout:
-            return
-        
-        # Устанавливаем следующее время выплаты (через 24 часа)
-        next_daily_payout = now + datetime.timedelta(hours=24)
-        
+        """Ежедневная выплата админ-валюты (запускается планировщиком)"""
         server_id = str(guild.id)
-        payout_log = []
-        payout_embed = discord.Embed(
-            title=f"{ADMIN_CURRENCY_SYMBOL} Ежедневная выплата {ADMIN_CURRENCY_NAME}",
-            color=discord.Color.purple()
-        )
         
+        # Собираем выплаты по всем ролям; участник с несколькими ролями получает сумму по ним
+        payouts: Dict[int, Tuple[discord.Member, int, List[str]]] = {}
         for role_id, amount in DAILY_ADMIN_ROLES.items():
             role = guild.get_role(role_id)
-            if not role:
+            if not role or amount <= 0:
                 continue
-                
             for member in role.members:
-                AdminCurrencySystem.update_balance(server_id, str(member.id), amount)
-                payout_log.append(f"{member.mention} ({role.name}): +{amount}{ADMIN_CURRENCY_SYMBOL}")
+                _, total, roles = payouts.get(member.id, (member, 0, []))
+                roles.append(role.name)
+                payouts[member.id] = (member, total + amount, roles)
         
-        # Отправляем уведомление в канал
-        if payout_log:
-            payout_embed.description = "\n".join(payout_log)
-            payout_embed.set_footer(text=f"Следующая выплата: {next_daily_payout.strftime('%d.%m.%Y в %H:%M')}")
-            
-            channel = guild.get_channel(ADMIN_PAYOUT_CHANNEL_ID)
-            if channel:
+        if not payouts:
+            return
+        
+        AdminCurrencySystem.apply_payouts(server_id, {str(member_id): total for member_id, (_, total, _) in payouts.items()})
+        
+        payout_log = [
+            f"{member.mention} ({', '.join(roles)}): +{total}{ADMIN_CURRENCY_SYMBOL}"
+            for member, total, roles in payouts.values()
+        ]
+        
+        # Отправляем уведомление в канал, разбив список на страницы в пределах лимита embed
+        channel = guild.get_channel(ADMIN_PAYOUT_CHANNEL_ID)
+        if channel:
+            next_run = scheduler.next_run(server_id, 'daily_payout')
+            pages = paginate_lines(payout_log)
+            for page_number, page in enumerate(pages, 1):
+                payout_embed = discord.Embed(
+                    title=f"{ADMIN_CURRENCY_SYMBOL} Ежедневная выплата {ADMIN_CURRENCY_NAME}",
+                    description=page,
+                    color=discord.Color.purple()
+                )
+                footer = f"Следующая выплата: {next_run.strftime('%d.%m.%Y в %H:%M')}" if next_run else ""
+                if len(pages) > 1:
+                    footer = f"Страница {page_number}/{len(pages)}" + (f" • {footer}" if footer else "")
+                payout_embed.set_footer(text=footer)
                 try:
                     await channel.send(embed=payout_embed)
                 except Exception as e:
                     print(f"Не удалось отправить уведомление о выплате: {str(e)}")
-            
-            # Логируем выплату в консоль
-            print(f"[Admin Currency] Ежедневная выплата выполнена:\n" + "\n".join(payout_log))
+                    break
+        
+        # Логируем выплату в консоль
+        total_paid = sum(total for _, total, _ in payouts.values())
+        print(f"[Admin Currency] Ежедневная выплата выполнена: {len(payouts)} участников, {total_paid}{ADMIN_CURRENCY_SYMBOL}")
 
 # Команды для работы с админ-валютой
 @bot.command(name='админбаланс')
@@ -1373,17 +3299,14 @@ async def add_admin_currency(ctx, member: discord.Member, amount: int):
 @bot.command(name='топадминвалюты')
 async def admin_currency_top(ctx):
     """Топ игроков по админ-валюте"""
-    data = AdminCurrencySystem.load_admin_currency()
-    server_data = data.get(str(ctx.guild.id), {})
-    
-    # Сбор и сортировка данных
+    # Берем лидеров из индекса, пропуская ушедших с сервера
     top_players = []
-    for user_id, amount in server_data.items():
-        member = ctx.guild.get_member(int(user_id))
-        if member:
-            top_players.append((member.display_name, amount))
-    
-    top_players.sort(key=lambda x: x[1], reverse=True)
+    for user_id, amount in leaderboards.get(ADMIN_CURRENCY_FILE, str(ctx.guild.id)).top():
+        name = guild_cache.display_name(ctx.guild, int(user_id))
+        if name:
+            top_players.append((name, amount))
+            if len(top_players) == 10:
+                break
     
     # Формирование embed
     embed = discord.Embed(
@@ -1403,16 +3326,10 @@ async def admin_currency_top(ctx):
 @bot.command(name='следующаявыплата', aliases=['nextpayout'])
 async def next_payout(ctx):
     """Показать время до следующей выплаты админ-валюты"""
-    global next_daily_payout
-    
-    if not next_daily_payout:
-        # Если выплата еще не производилась, устанавливаем следующее время
-        now = datetime.datetime.now()
-        next_daily_payout = now + datetime.timedelta(hours=24)
-        await AdminCurrencySystem.process_daily_payout(ctx.guild)
+    next_daily_payout = scheduler.next_run(str(ctx.guild.id), 'daily_payout')
     
     now = datetime.datetime.now()
-    if now >= next_daily_payout:
+    if not next_daily_payout or now >= next_daily_payout:
         embed = discord.Embed(
             title=f"{ADMIN_CURRENCY_SYMBOL} Выплата админ-валюты",
             description="Следующая выплата должна произойти в любое время!",
@@ -1441,6 +3358,46 @@ async def next_payout(ctx):
     
     await ctx.send(embed=embed)
 
+@bot.command(name='метрики', aliases=['metrics'])
+@commands.has_any_role(*ADMIN_ROLE_IDS)
+async def show_metrics(ctx):
+    """Показать время выполнения команд, работы с файлами и запросов к Discord"""
+    embed = discord.Embed(
+        title="📊 Метрики бота",
+        color=discord.Color.dark_blue()
+    )
+    
+    def ms(seconds: float) -> str:
+        return f"{seconds * 1000:.0f}мс" if seconds != float('inf') else ">10с"
+    
+    # Самые медленные команды по p99
+    commands_by_p99 = sorted(metrics.commands.items(), key=lambda x: x[1].quantile(0.99), reverse=True)
+    lines = []
+    for name, hist in commands_by_p99[:10]:
+        http_share = metrics.command_http.get(name, 0.0) / hist.sum if hist.sum else 0
+        lines.append(f"`+{name}`: {hist.count} выз., p50 {ms(hist.quantile(0.5))}, "
+                     f"p99 {ms(hist.quantile(0.99))}, Discord API {http_share:.0%}")
+    embed.add_field(name="⌛ Команды", value="\n".join(lines) or "Нет данных", inline=False)
+    
+    # Работа с хранилищем
+    with metrics.lock:
+        io = sorted(metrics.io.items())
+        io_bytes = dict(metrics.io_bytes)
+    lines = [f"{filename} {operation}: {hist.count} раз, p99 {ms(hist.quantile(0.99))}, "
+             f"{io_bytes.get((operation, filename), 0) // 1024} КБ"
+             for (operation, filename), hist in io]
+    embed.add_field(name="💾 Хранилище", value="\n".join(lines)[:1024] or "Нет данных", inline=False)
+    
+    # Запросы к Discord по маршрутам
+    routes = sorted(metrics.http.items(), key=lambda x: x[1].count, reverse=True)
+    lines = [f"{method} {path}: {hist.count}, p99 {ms(hist.quantile(0.99))}"
+             for (method, path), hist in routes[:10]]
+    embed.add_field(name="🌐 Discord HTTP", value="\n".join(lines)[:1024] or "Нет данных", inline=False)
+    
+    if METRICS_PORT:
+        embed.set_footer(text=f"Prometheus: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    await ctx.send(embed=embed)
+
 @bot.command(name='админ')
 @commands.has_any_role(*ADMIN_ROLE_IDS)
 async def admin_commands(ctx):
@@ -1493,7 +3450,11 @@ async def admin_commands(ctx):
         name="⚙️ **Системные команды**",
         value=(
             "`+проверка` - Проверить работоспособность бота\n"
-            "`+следующаявыплата` - Время до следующей выплаты админ-валюты"
+            "`+метрики` - Время выполнения команд и работы с данными\n"
+            "`+следующаявыплата` - Время до следующей выплаты админ-валюты\n"
+            "`+снимок [метка]` - Сделать снимок экономики сервера\n"
+            "`+снимки` - Список снимков\n"
+            "`+восстановить <id>` - Вернуть экономику к снимку"
         ),
         inline=False
     )
@@ -1504,138 +3465,754 @@ async def admin_commands(ctx):
 @bot.event
 async def on_ready():
     print(f'Бот {bot.user.name} запущен!')
-    # Запускаем фоновую задачу для выплат
-    bot.loop.create_task(daily_payout_task())
+    # Загружаем данные в память (повторные вызовы ничего не перечитывают)
+    await asyncio.gather(*(store.load_async(filename) for filename in
+                           (INVENTORY_FILE, CURRENCY_FILE, CASES_FILE, ADMIN_CURRENCY_FILE, SCHEDULE_FILE,
+                            ESCROW_FILE)))
+    # Обмены, прерванные перезапуском, не восстанавливаются - возвращаем их эскроу владельцам
+    trades.refund_orphans()
+    # Эндпоинт метрик для Prometheus
+    try:
+        await metrics.start_server()
+    except OSError as e:
+        print(f"Не удалось запустить эндпоинт метрик: {str(e)}")
+    # Запускаем планировщик выплат (при переподключении повторно не запускается)
+    scheduler.start()
+    # Процессы без общих файлов подхватывают кейсы, измененные в процессе шарда 0
+    global reload_task
+    if not owns_global_files() and (reload_task is None or reload_task.done()):
+        reload_task = asyncio.get_running_loop().create_task(reload_global_files())
 
-async def daily_payout_task():
-    await bot.wait_until_ready()  # Ждем, пока бот полностью запустится
-    while not bot.is_closed():
-        for guild in bot.guilds:
-            await AdminCurrencySystem.process_daily_payout(guild)
-        await asyncio.sleep(3600)  # Проверка каждый час
-
-# Добавляем новый класс для интерфейса обмена
-class TradeView(View):
-    def __init__(self, ctx, initiator: discord.Member, recipient: discord.Member, initiator_items: List[str], recipient_items: List[str], initiator_currency: Dict[str, int], recipient_currency: Dict[str, int]):
-        super().__init__(timeout=300)
-        self.ctx = ctx
+@bot.event
+async def on_guild_join(guild):
+    # Новый сервер: планировщик пересчитывает ближайшую задачу
+    scheduler.wake()
+
+# --- Планировщик периодических задач ---
+class Scheduler:
+    """Запускает периодические задачи для каждого сервера. Время следующего запуска хранится
+    в SCHEDULE_FILE ({server_id: {задача: unix-время}}), между запусками задача спит
+    ровно до ближайшего срока, а не опрашивает расписание"""
+
+    def __init__(self):
+        self.jobs: Dict[str, Tuple[float, object]] = {}  # Имя -> (интервал в секундах, обработчик)
+        self.task: Optional[asyncio.Task] = None
+        self.wakeup: Optional[asyncio.Event] = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+
+    def job(self, name: str, interval: float):
+        """Декоратор: регистрирует async-обработчик handler(guild) с заданным интервалом"""
+        def decorator(handler):
+            self.jobs[name] = (interval, handler)
+            return handler
+        return decorator
+
+    def next_run(self, server_id: str, name: str) -> Optional[datetime.datetime]:
+        """Время следующего запуска задачи на сервере (None - еще не запускалась)"""
+        timestamp = store.partition(SCHEDULE_FILE, server_id, create=False).get(name)
+        return datetime.datetime.fromtimestamp(timestamp) if timestamp is not None else None
+
+    def start(self):
+        """Запускает единственный экземпляр цикла планировщика"""
+        if self.task and not self.task.done():
+            return
+        self.wakeup = asyncio.Event()
+        self.semaphore = asyncio.Semaphore(SCHEDULER_CONCURRENCY)
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def wake(self):
+        """Прерывает ожидание, чтобы пересчитать ближайший срок"""
+        if self.wakeup:
+            self.wakeup.set()
+
+    def advance(self, server_id: str, name: str, previous: Optional[float], now: float):
+        """Сохраняет следующий срок задачи. Делается до выполнения: сбой внутри задачи не приведет
+        к повторной выплате. Пропущенные за время простоя сроки не наверстываются, но сетка расписания сохраняется"""
+        interval, _ = self.jobs[name]
+        if previous is None:
+            next_run = now + interval
+        else:
+            next_run = previous + ((now - previous) // interval + 1) * interval
+        store.partition(SCHEDULE_FILE, server_id)[name] = next_run
+        store.mark_dirty(SCHEDULE_FILE, server_id, name)
+
+    async def run_job(self, guild, name: str):
+        _, handler = self.jobs[name]
+        async with self.semaphore:
+            metrics.current_command.set(name)  # Причина движений валюты в журнале - имя задачи
+            try:
+                await handler(guild)
+            except Exception as e:
+                print(f"[Планировщик] Ошибка задачи {name} на сервере {guild.id}: {str(e)}")
+
+    async def run(self):
+        await bot.wait_until_ready()  # Ждем, пока бот полностью запустится
+        while not bot.is_closed():
+            # Собираем задачи, срок которых наступил, сразу по всем серверам
+            now = time.time()
+            due = []
+            due_at = None
+            for guild in list(bot.guilds):
+                server_id = str(guild.id)
+                schedule = store.partition(SCHEDULE_FILE, server_id, create=False)
+                for name in self.jobs:
+                    next_run = schedule.get(name)
+                    if next_run is None or next_run <= now:
+                        self.advance(server_id, name, next_run, now)
+                        due.append((guild, name))
+                    else:
+                        due_at = next_run if due_at is None else min(due_at, next_run)
+
+            if due:
+                # Серверы обрабатываются параллельно, но не больше SCHEDULER_CONCURRENCY одновременно
+                await asyncio.gather(*(self.run_job(guild, name) for guild, name in due))
+                continue  # Пересчитываем ближайший срок с учетом новых запусков
+
+            self.wakeup.clear()
+            timeout = max(0.0, due_at - time.time()) if due_at is not None else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+scheduler = Scheduler()
+
+@scheduler.job('daily_payout', DAILY_PAYOUT_INTERVAL)
+async def daily_payout_job(guild: discord.Guild):
+    await AdminCurrencySystem.process_daily_payout(guild)
+
+if INTEREST_RATES:
+    @scheduler.job('interest', INTEREST_INTERVAL)
+    async def interest_job(guild: discord.Guild):
+        changed = CurrencySystem.apply_rates(str(guild.id), INTEREST_RATES)
+        print(f"[Планировщик] Проценты начислены на сервере {guild.id}: {changed} игроков")
+
+if DECAY_RATES:
+    @scheduler.job('decay', DECAY_INTERVAL)
+    async def decay_job(guild: discord.Guild):
+        changed = CurrencySystem.apply_rates(str(guild.id), {currency: -rate for currency, rate in DECAY_RATES.items()},
+                                             threshold=DECAY_THRESHOLD)
+        print(f"[Планировщик] Списание с крупных балансов на сервере {guild.id}: {changed} игроков")
+
+# --- Снимки экономики ---
+SNAPSHOT_FILES = [CURRENCY_FILE, ADMIN_CURRENCY_FILE, INVENTORY_FILE]
+
+class SnapshotManager:
+    """Снимки данных сервера на момент времени. Раздел файла делится по игрокам на SNAPSHOT_BUCKETS
+    частей, каждая лежит в blobs/ под своим хэшем, а снимок - манифест {файл: [хэши частей]}.
+    Части без измененных с прошлого снимка игроков не копируются и не записываются повторно"""
+
+    COPY_CHUNK = 5000  # Сколько игроков копируется за один проход цикла событий
+
+    def __init__(self, directory: str = SNAPSHOT_DIR):
+        self.directory = directory
+        # (файл, сервер) -> (игроки каждой части, хэши частей) на момент последнего снимка
+        self.state: Dict[Tuple[str, str], Tuple[List[set], List[str]]] = {}
+        self.lock: Optional[asyncio.Lock] = None  # Снимки делаются по одному: каждый опирается на предыдущий
+
+    def guild_dir(self, server_id: str) -> str:
+        return os.path.join(self.directory, server_id)
+
+    def blob_path(self, server_id: str, digest: str) -> str:
+        return os.path.join(self.guild_dir(server_id), 'blobs', f"{digest}.json")
+
+    @staticmethod
+    def bucket(user_id: str) -> int:
+        return int(user_id) % SNAPSHOT_BUCKETS if user_id.isdigit() else zlib.crc32(user_id.encode('utf-8')) % SNAPSHOT_BUCKETS
+
+    @staticmethod
+    def copy_value(value):
+        # Значения разделов - числа или плоские словари ({валюта: сумма}, {предмет: количество})
+        return dict(value) if isinstance(value, dict) else value
+
+    def update_members(self, members: List[set], user_ids, partition: dict) -> set:
+        """Переносит измененных игроков в их части (или убирает удаленных); возвращает номера частей"""
+        buckets = set()
+        for user_id in user_ids:
+            bucket = self.bucket(user_id)
+            if user_id in partition:
+                members[bucket].add(user_id)
+            else:
+                members[bucket].discard(user_id)
+            buckets.add(bucket)
+        return buckets
+
+    async def create(self, server_id: str, label: str = "auto") -> Tuple[str, int]:
+        """Делает снимок сервера; возвращает его id и число заново записанных частей.
+        Значения копируются порциями между которыми работают команды; измененные за это время
+        игроки в конце копируются заново, поэтому снимок соответствует моменту окончания копирования.
+        Сериализация и хэширование идут в пуле потоков"""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            jobs = {}
+            for filename in SNAPSHOT_FILES:
+                partition = store.partition(filename, server_id, create=False)
+                changed = store.take_changes(filename, server_id)
+                state = self.state.pop((filename, server_id), None)
+                if state is None or changed is None:
+                    # Первый снимок после запуска или замена раздела целиком: копируется весь раздел
+                    jobs[filename] = (None, None, None, list(partition))
+                else:
+                    members, digests = state
+                    dirty = self.update_members(members, changed, partition)
+                    jobs[filename] = (members, digests, dirty, [user_id for bucket in dirty for user_id in members[bucket]])
+
+            copies = {filename: {} for filename in jobs}
+            for filename, (_, _, _, user_ids) in jobs.items():
+                for start in range(0, len(user_ids), self.COPY_CHUNK):
+                    partition = store.partition(filename, server_id, create=False)
+                    for user_id in user_ids[start:start + self.COPY_CHUNK]:
+                        if user_id in partition:
+                            copies[filename][user_id] = self.copy_value(partition[user_id])
+                    await asyncio.sleep(0)
+
+            # Без await: изменения, сделанные во время копирования, переносятся в копии
+            manifest = {"created": time.time(), "label": label, "files": {}}
+            for filename, (members, digests, dirty, _) in list(jobs.items()):
+                partition = store.partition(filename, server_id, create=False)
+                during = store.changes.get((filename, server_id), set())  # Остаются и для следующего снимка
+                values = copies[filename]
+                if during is None:
+                    copies[filename] = {user_id: self.copy_value(value) for user_id, value in partition.items()}
+                    jobs[filename] = (None, None, None, None)
+                    continue
+                for user_id in during:
+                    if user_id in partition:
+                        values[user_id] = self.copy_value(partition[user_id])
+                    else:
+                        values.pop(user_id, None)
+                if members is not None:
+                    for bucket in self.update_members(members, during, partition) - dirty:
+                        dirty.add(bucket)
+                        for user_id in members[bucket] & partition.keys():
+                            values[user_id] = self.copy_value(partition[user_id])
+            jobs = {filename: (members, digests, dirty, copies[filename])
+                    for filename, (members, digests, dirty, _) in jobs.items()}
+
+            # При ошибке состояние не восстанавливается: следующий снимок запишет разделы целиком
+            snapshot_id, written, states = await store.io.run(SNAPSHOT_DIR, self.write, server_id, manifest, jobs)
+            for filename, state in states.items():
+                self.state[(filename, server_id)] = state
+            return snapshot_id, written
+
+    @staticmethod
+    def write_file(path: str, data: bytes):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def write(self, server_id: str, manifest: dict, jobs: Dict[str, tuple]) -> Tuple[str, int, dict]:
+        """Сериализует и записывает измененные части и манифест, затем удаляет устаревшие снимки
+        (выполняется в пуле). jobs: файл -> (игроки частей, хэши частей, измененные части, копии значений);
+        для раздела целиком первые три - None"""
+        directory = self.guild_dir(server_id)
+        os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+        written = 0
+        states = {}
+        for filename, (members, digests, dirty, data) in jobs.items():
+            if members is None:
+                members = [set() for _ in range(SNAPSHOT_BUCKETS)]
+                for user_id in data:
+                    members[self.bucket(user_id)].add(user_id)
+                dirty = range(SNAPSHOT_BUCKETS)
+                digests = [""] * SNAPSHOT_BUCKETS
+            else:
+                digests = list(digests)
+            for bucket in dirty:
+                values = {user_id: data[user_id] for user_id in members[bucket] if user_id in data}
+                blob = json.dumps(values, ensure_ascii=False, sort_keys=True).encode('utf-8')
+                digest = hashlib.sha256(blob).hexdigest()
+                path = self.blob_path(server_id, digest)
+                if not os.path.exists(path):
+                    with metrics.time_io('write', SNAPSHOT_DIR, len(blob)):
+                        self.write_file(path, blob)
+                    written += 1
+                digests[bucket] = digest
+            manifest["files"][filename] = digests
+            states[filename] = (members, digests)
+
+        base_id = datetime.datetime.fromtimestamp(manifest["created"]).strftime('%Y%m%d-%H%M%S')
+        snapshot_id = base_id
+        suffix = 1
+        while os.path.exists(os.path.join(directory, f"{snapshot_id}.json")):
+            suffix += 1
+            snapshot_id = f"{base_id}-{suffix}"
+        manifest["id"] = snapshot_id
+        self.write_file(os.path.join(directory, f"{snapshot_id}.json"),
+                        json.dumps(manifest, ensure_ascii=False).encode('utf-8'))
+        self.prune(server_id)
+        return snapshot_id, written, states
+
+    @staticmethod
+    def digests(manifest: dict, filename: str) -> List[str]:
+        digests = manifest["files"][filename]
+        return [digests] if isinstance(digests, str) else digests  # Прежний формат: раздел одной частью
+
+    def manifests(self, server_id: str) -> List[dict]:
+        """Снимки сервера, от новых к старым"""
+        directory = self.guild_dir(server_id)
+        if not os.path.isdir(directory):
+            return []
+        result = []
+        for name in os.listdir(directory):
+            if name.endswith('.json'):
+                with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+                    result.append(json.load(f))
+        result.sort(key=lambda manifest: manifest["created"], reverse=True)
+        return result
+
+    def prune(self, server_id: str):
+        """Оставляет SNAPSHOT_KEEP последних снимков и удаляет части, на которые они не ссылаются"""
+        manifests = self.manifests(server_id)
+        for manifest in manifests[SNAPSHOT_KEEP:]:
+            os.remove(os.path.join(self.guild_dir(server_id), f"{manifest['id']}.json"))
+        referenced = {digest for manifest in manifests[:SNAPSHOT_KEEP]
+                      for filename in manifest["files"] for digest in self.digests(manifest, filename)}
+        blob_dir = os.path.join(self.guild_dir(server_id), 'blobs')
+        for name in os.listdir(blob_dir):
+            if name[:-len('.json')] not in referenced:
+                os.remove(os.path.join(blob_dir, name))
+
+    def read(self, server_id: str, snapshot_id: str) -> Optional[Dict[str, dict]]:
+        """Данные снимка {файл: раздел сервера} или None, если снимка нет"""
+        path = os.path.join(self.guild_dir(server_id), f"{os.path.basename(snapshot_id)}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        data = {}
+        for filename in manifest["files"]:
+            partition = data[filename] = {}
+            for digest in self.digests(manifest, filename):
+                with open(self.blob_path(server_id, digest), 'r', encoding='utf-8') as f:
+                    partition.update(json.load(f))
+        return data
+
+    async def restore(self, server_id: str, snapshot_id: str) -> Optional[str]:
+        """Возвращает данные сервера к снимку без перезапуска бота. Перед этим делается снимок
+        текущего состояния, так что восстановление можно отменить. Возвращает id этого снимка"""
+        data = await store.io.run(SNAPSHOT_DIR, self.read, server_id, snapshot_id)
+        if data is None:
+            return None
+        # Эскроу обменов взят из текущего состояния: завершение обмена после восстановления
+        # выдало бы его второй раз. Обмены отменяются до снимка, чтобы возвращенное попало в него
+        cancelled = "❌ Обмен отменен: данные сервера восстановлены из снимка"
+        trades.end_guild(server_id, cancelled)
+        backup_id, _ = await self.create(server_id, f"до восстановления {snapshot_id}")
+
+        # Разделы подменяются без await: команды видят либо старое, либо восстановленное состояние
+        trades.end_guild(server_id, cancelled)  # Обмены, начатые пока делался снимок
+        for filename, partition in data.items():
+            files = store.load(filename)
+            if partition:
+                files[server_id] = partition
+            elif files.pop(server_id, None) is None:
+                continue
+            store.mark_dirty(filename, server_id)
+            leaderboards.invalidate(filename, server_id)
+        for key in [key for key in inventory_index if key[0] == server_id]:
+            del inventory_index[key]
+        return backup_id
+
+snapshots = SnapshotManager()
+
+if SNAPSHOT_INTERVAL:
+    @scheduler.job('snapshot', SNAPSHOT_INTERVAL)
+    async def snapshot_job(guild: discord.Guild):
+        snapshot_id, written = await snapshots.create(str(guild.id))
+        print(f"[Снимки] Снимок {snapshot_id} сервера {guild.id}: записано частей {written}")
+
+@bot.command(name='снимок')
+@commands.has_any_role(*ADMIN_ROLE_IDS)
+async def create_snapshot(ctx, *, label: str = "вручную"):
+    """Сделать снимок валюты, админ-валюты и инвентарей сервера"""
+    snapshot_id, written = await snapshots.create(str(ctx.guild.id), label)
+    await ctx.send(f"📸 Снимок `{snapshot_id}` создан (новых частей: {written} из {len(SNAPSHOT_FILES) * SNAPSHOT_BUCKETS})")
+
+@bot.command(name='снимки')
+@commands.has_any_role(*ADMIN_ROLE_IDS)
+async def list_snapshots(ctx):
+    """Показать последние снимки сервера"""
+    manifests = await store.io.run(SNAPSHOT_DIR, snapshots.manifests, str(ctx.guild.id))
+    if not manifests:
+        return await ctx.send("ℹ️ Снимков пока нет")
+    
+    lines = [f"`{manifest['id']}` <t:{int(manifest['created'])}:f> - {manifest['label']}" for manifest in manifests]
+    pages = paginate_lines(lines)
+    embed = discord.Embed(
+        title="📸 Снимки сервера",
+        description=pages[0],
+        color=discord.Color.blue()
+    )
+    embed.set_footer(text="Восстановление: +восстановить <id>")
+    await ctx.send(embed=embed)
+
+@bot.command(name='восстановить')
+@commands.has_any_role(*ADMIN_ROLE_IDS)
+async def restore_snapshot(ctx, snapshot_id: str):
+    """Вернуть валюту, админ-валюту и инвентари сервера к снимку"""
+    backup_id = await snapshots.restore(str(ctx.guild.id), snapshot_id)
+    if backup_id is None:
+        return await ctx.send(f"❌ Снимок `{snapshot_id}` не найден! Список: +снимки")
+    await ctx.send(f"✅ Данные восстановлены из снимка `{snapshot_id}`. "
+                   f"Прежнее состояние сохранено в снимке `{backup_id}`")
+
+# --- Обмены ---
+def escrow_offer(server_id: str, user_id: str, items: Dict[str, int], currency: Dict[str, int]) -> bool:
+    """Забирает у игрока предложенные предметы и валюту в эскроу. Ничего не забирает и
+    возвращает False, если чего-то не хватает"""
+    owned = get_inventory(server_id, user_id)
+    if any(owned.get(item, 0) < count for item, count in items.items()):
+        return False
+    if not CurrencySystem.apply_batch(server_id, [(user_id, name, -amount) for name, amount in currency.items()]):
+        return False
+    for item, count in items.items():
+        remove_from_inventory(server_id, user_id, item, count)
+    store.partition(ESCROW_FILE, server_id)[user_id] = {"items": dict(items), "currency": dict(currency)}
+    store.mark_dirty(ESCROW_FILE, server_id, user_id)
+    return True
+
+def release_escrow(server_id: str, user_id: str, to_user_id: str):
+    """Отдает ценности из эскроу игрока user_id игроку to_user_id (себе же - возврат)"""
+    held = store.partition(ESCROW_FILE, server_id, create=False).pop(user_id, None)
+    if held is None:
+        return
+    store.mark_dirty(ESCROW_FILE, server_id, user_id)
+    CurrencySystem.apply_batch(server_id, [(to_user_id, name, amount) for name, amount in held["currency"].items()])
+    if held["items"]:
+        add_to_inventory(server_id, to_user_id, counts=held["items"])
+
+class TradeSession:
+    """Состояние одного обмена: предложения сторон и подтверждения. Подтвердивший игрок сразу
+    отдает свое предложение в эскроу, поэтому до конца сделки не может потратить его в другом месте"""
+
+    def __init__(self, guild, initiator: discord.Member, recipient: discord.Member):
+        self.server_id = str(guild.id)
         self.initiator = initiator
         self.recipient = recipient
-        self.initiator_items = initiator_items
-        self.recipient_items = recipient_items
-        self.initiator_currency = initiator_currency
-        self.recipient_currency = recipient_currency
+        self.initiator_items: Dict[str, int] = {}
+        self.recipient_items: Dict[str, int] = {}
+        self.initiator_currency: Dict[str, int] = {}
+        self.recipient_currency: Dict[str, int] = {}
         self.confirmations = set()
-        
-        # Добавляем кнопки
-        self.add_item(Button(style=discord.ButtonStyle.green, label="Подтвердить", custom_id="confirm"))
-        self.add_item(Button(style=discord.ButtonStyle.red, label="Отменить", custom_id="cancel"))
-        
-    async def interaction_check(self, interaction: discord.Interaction) -> bool:
-        # Проверяем, что взаимодействие от одного из участников обмена
-        return interaction.user.id in [self.initiator.id, self.recipient.id]
-    
-    async def update_embed(self):
+        self.completed = False
+        self.view: Optional[View] = None
+        self.message = None
+        self.touch()
+
+    def touch(self):
+        """Продлевает обмен: он истекает после TRADE_TIMEOUT секунд без нажатий"""
+        self.expires_at = time.monotonic() + TRADE_TIMEOUT
+
+    def offer(self, user_id: int) -> Tuple[Dict[str, int], Dict[str, int]]:
+        if user_id == self.initiator.id:
+            return self.initiator_items, self.initiator_currency
+        return self.recipient_items, self.recipient_currency
+
+    def set_offer(self, is_initiator: bool, items: Optional[Dict[str, int]] = None,
+                  currency: Optional[Dict[str, int]] = None):
+        """Меняет предложение стороны; прежние подтверждения снимаются, эскроу возвращается"""
+        self.reset()
+        if is_initiator:
+            self.initiator_items = self.initiator_items if items is None else items
+            self.initiator_currency = self.initiator_currency if currency is None else currency
+        else:
+            self.recipient_items = self.recipient_items if items is None else items
+            self.recipient_currency = self.recipient_currency if currency is None else currency
+
+    def holdings(self, user_id: int) -> Dict[str, int]:
+        """Предметы игрока, включая отданные в эскроу этого обмена"""
+        held = Counter(get_inventory(self.server_id, str(user_id)))
+        if user_id in self.confirmations:
+            held.update(self.offer(user_id)[0])
+        return dict(held)
+
+    def balance(self, user_id: int, currency: str) -> int:
+        """Баланс игрока, включая валюту в эскроу этого обмена"""
+        balance = CurrencySystem.get_balance(self.server_id, str(user_id), currency)
+        if user_id in self.confirmations:
+            balance += self.offer(user_id)[1].get(currency, 0)
+        return balance
+
+    def confirm(self, user_id: int) -> bool:
+        """Подтверждение игрока: его предложение уходит в эскроу. False, если его не хватает"""
+        if user_id in self.confirmations:
+            return True
+        items, currency = self.offer(user_id)
+        if not escrow_offer(self.server_id, str(user_id), items, currency):
+            return False
+        self.confirmations.add(user_id)
+        return True
+
+    def reset(self):
+        """Снимает подтверждения и возвращает эскроу владельцам"""
+        for user_id in self.confirmations:
+            release_escrow(self.server_id, str(user_id), str(user_id))
+        self.confirmations.clear()
+
+    def complete(self):
+        """Оба подтвердили: каждый получает эскроу другой стороны"""
+        initiator_id, recipient_id = str(self.initiator.id), str(self.recipient.id)
+        release_escrow(self.server_id, initiator_id, recipient_id)
+        release_escrow(self.server_id, recipient_id, initiator_id)
+        self.confirmations.clear()
+        self.completed = True
+
+    def create_embed(self) -> discord.Embed:
         embed = discord.Embed(
             title="🔁 Обмен предметами",
             description=f"Обмен между {self.initiator.mention} и {self.recipient.mention}",
             color=discord.Color.blue()
         )
         
-        # Предметы и валюта инициатора
-        initiator_text = "**Предметы:**\n"
-        initiator_text += "\n".join(f"• {item}" for item in self.initiator_items) if self.initiator_items else "Нет предметов"
-        
-        initiator_text += "\n\n**Валюта:**\n"
-        initiator_text += "\n".join(f"• {amount} {CURRENCIES[currency]}" for currency, amount in self.initiator_currency.items()) if self.initiator_currency else "Нет валюты"
-        
-        # Предметы и валюта получателя
-        recipient_text = "**Предметы:**\n"
-        recipient_text += "\n".join(f"• {item}" for item in self.recipient_items) if self.recipient_items else "Нет предметов"
-        
-        recipient_text += "\n\n**Валюта:**\n"
-        recipient_text += "\n".join(f"• {amount} {CURRENCIES[currency]}" for currency, amount in self.recipient_currency.items()) if self.recipient_currency else "Нет валюты"
-        
-        embed.add_field(name=f"От {self.initiator.display_name}", value=initiator_text, inline=True)
-        embed.add_field(name=f"К {self.recipient.display_name}", value=recipient_text, inline=True)
+        for prefix, member in (("От", self.initiator), ("К", self.recipient)):
+            items, currency = self.offer(member.id)
+            text = "**Предметы:**\n"
+            text += "\n".join(f"• {item} ×{count}" for item, count in items.items()) if items else "Нет предметов"
+            text += "\n\n**Валюта:**\n"
+            text += "\n".join(f"• {amount} {CURRENCIES[name]}" for name, amount in currency.items()) if currency else "Нет валюты"
+            embed.add_field(name=f"{prefix} {member.display_name}", value=text, inline=True)
         
         # Статус подтверждения
-        status = []
-        if self.initiator.id in self.confirmations:
-            status.append(f"{self.initiator.display_name} ✅")
-        else:
-            status.append(f"{self.initiator.display_name} ❌")
-            
-        if self.recipient.id in self.confirmations:
-            status.append(f"{self.recipient.display_name} ✅")
-        else:
-            status.append(f"{self.recipient.display_name} ❌")
-            
+        status = [f"{member.display_name} {'✅' if member.id in self.confirmations else '❌'}"
+                  for member in (self.initiator, self.recipient)]
         embed.add_field(name="Подтверждения", value="\n".join(status), inline=False)
-        
         return embed
-    
-    @discord.ui.button(style=discord.ButtonStyle.green, label="Подтвердить", custom_id="confirm")
-    async def confirm_callback(self, interaction: discord.Interaction, button: Button):
-        self.confirmations.add(interaction.user.id)
+
+class TradeSessionManager:
+    """Реестр активных обменов: у игрока на сервере не больше одного обмена. Завершенный,
+    отмененный или истекший обмен сразу удаляется вместе с view, эскроу возвращается владельцам"""
+
+    def __init__(self):
+        self.sessions: Dict[Tuple[str, str], TradeSession] = {}  # (сервер, игрок) -> обмен
+
+    def start(self, guild, initiator: discord.Member, recipient: discord.Member) -> Optional[TradeSession]:
+        """Начинает обмен; None, если у кого-то из игроков уже есть активный обмен"""
+        self.sweep()
+        server_id = str(guild.id)
+        keys = [(server_id, str(member.id)) for member in (initiator, recipient)]
+        if any(key in self.sessions for key in keys):
+            return None
+        session = TradeSession(guild, initiator, recipient)
+        for key in keys:
+            self.sessions[key] = session
+        return session
+
+    def active(self, session: TradeSession) -> bool:
+        """Обмен не завершен и все еще зарегистрирован (не отменен и не истек)"""
+        key = (session.server_id, str(session.initiator.id))
+        return not session.completed and self.sessions.get(key) is session
+
+    def end(self, session: TradeSession):
+        """Убирает обмен из реестра и освобождает его view"""
+        if not session.completed:
+            session.reset()
+        for member in (session.initiator, session.recipient):
+            key = (session.server_id, str(member.id))
+            if self.sessions.get(key) is session:
+                del self.sessions[key]
+        if session.view is not None:
+            session.view.stop()
+            session.view = None
+
+    def expire(self, session: TradeSession, title: str = "⌛ Обмен истек"):
+        """Завершает обмен по истечении времени и убирает кнопки из его сообщения"""
+        self.end(session)
+        if session.message is None:
+            return
+        embed = discord.Embed(
+            title=title,
+            description="Предложенные предметы и валюта возвращены владельцам",
+            color=discord.Color.dark_grey()
+        )
+        message, session.message = session.message, None
+        try:
+            asyncio.get_running_loop().create_task(self.close_message(message, embed))
+        except RuntimeError:
+            pass
+
+    @staticmethod
+    async def close_message(message, embed: discord.Embed):
+        try:
+            await message.edit(embed=embed, view=None)
+        except discord.HTTPException as e:
+            print(f"Не удалось обновить сообщение обмена {message.id}: {str(e)}")
+
+    def end_guild(self, server_id: str, title: str):
+        """Отменяет все активные обмены сервера с возвратом эскроу"""
+        for session in {id(session): session for key, session in self.sessions.items() if key[0] == server_id}.values():
+            self.expire(session, title)
+
+    def sweep(self):
+        """Завершает обмены, по которым давно не было нажатий (на случай, если таймаут view не сработал)"""
+        now = time.monotonic()
+        for session in {id(session): session for session in self.sessions.values()}.values():
+            if session.expires_at <= now:
+                self.expire(session)
+
+    def refund_orphans(self):
+        """Возвращает эскроу обменов, которых нет в памяти (прерваны перезапуском бота)"""
+        for server_id, partition in list(store.load(ESCROW_FILE).items()):
+            for user_id in list(partition):
+                if (server_id, user_id) not in self.sessions:
+                    release_escrow(server_id, user_id, user_id)
+
+trades = TradeSessionManager()
+
+class TradeSetupView(View):
+    """Кнопки обмена: выбор предметов и валюты, подтверждение и отмена"""
+
+    def __init__(self, session: TradeSession):
+        super().__init__(timeout=TRADE_TIMEOUT)
+        self.session = session
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # Проверяем, что взаимодействие от одного из участников обмена
+        if interaction.user.id not in (self.session.initiator.id, self.session.recipient.id):
+            await interaction.response.send_message("❌ Вы не участник этого обмена!", ephemeral=True)
+            return False
+        metrics.current_command.set('обмен')  # Причина движений валюты в журнале
+        self.session.touch()
+        return True
+
+    async def on_timeout(self):
+        trades.expire(self.session)
+
+    @discord.ui.button(label="Выбрать предметы", style=discord.ButtonStyle.blurple)
+    async def select_items(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if not await admit(interaction, 'trade'):
+            return
+        modal = ItemSelectModal(self.session, interaction.user.id == self.session.initiator.id)
+        await interaction.response.send_modal(modal)
+
+    @discord.ui.button(label="Выбрать валюту", style=discord.ButtonStyle.blurple)
+    async def select_currency(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if not await admit(interaction, 'trade'):
+            return
+        modal = CurrencySelectModal(self.session, interaction.user.id == self.session.initiator.id)
+        await interaction.response.send_modal(modal)
+
+    @discord.ui.button(label="Подтвердить обмен", style=discord.ButtonStyle.green)
+    async def confirm_trade(self, interaction: discord.Interaction, button: discord.ui.Button):
+        session = self.session
+        # Нажатие могло прийти в одной пачке с завершившим обмен: повторный confirm забрал бы
+        # предложение в эскроу обмена, которого уже нет
+        if not trades.active(session):
+            return await interaction.response.defer()
+        if not await admit(interaction, 'trade'):
+            return
+        # Нажатие, завершающее обмен, занимает ключ операции до того, как что-то уйдет в эскроу:
+        # повтор отклоняется, ничего не изменив
+        key = f"trade:{interaction.message.id}"
+        completes = session.confirmations | {interaction.user.id} == {session.initiator.id, session.recipient.id}
+        if completes and not await claim_operation(interaction, key):
+            return
+        if not session.confirm(interaction.user.id):
+            if completes:
+                operations.release(key)
+            await interaction.response.send_message("❌ У вас не хватает предметов или валюты из вашего предложения!",
+                                                    ephemeral=True)
+            return
         
-        if len(self.confirmations) == 2:
-            # Оба подтвердили - выполняем обмен
-            await self.execute_trade()
-            embed = await self.update_embed()
+        if completes:
+            # Оба подтвердили - выполняем обмен (один раз на сообщение обмена)
+            session.complete()
+            trades.end(session)
+            embed = session.create_embed()
             embed.title = "✅ Обмен завершен!"
             embed.color = discord.Color.green()
-            await interaction.response.edit_message(embed=embed, view=None)
+            await coalescer.edit_now(interaction, embed=embed, view=None)
         else:
             # Ждем второго подтверждения
-            embed = await self.update_embed()
-            await interaction.response.edit_message(embed=embed)
-    
-    @discord.ui.button(style=discord.ButtonStyle.red, label="Отменить", custom_id="cancel")
-    async def cancel_callback(self, interaction: discord.Interaction, button: Button):
+            await coalescer.edit(interaction, lambda: {'embed': session.create_embed()})
+
+    @discord.ui.button(label="Отменить обмен", style=discord.ButtonStyle.red)
+    async def cancel_trade(self, interaction: discord.Interaction, button: discord.ui.Button):
+        trades.end(self.session)
         embed = discord.Embed(
             title="❌ Обмен отменен",
             description=f"{interaction.user.mention} отменил обмен",
             color=discord.Color.red()
         )
-        await interaction.response.edit_message(embed=embed, view=None)
-        self.stop()
-    
-    async def execute_trade(self):
-        # Обновляем инвентари
-        inventory = load_data(INVENTORY_FILE)
-        server_id = str(self.ctx.guild.id)
+        await coalescer.edit_now(interaction, embed=embed, view=None)
+
+class ItemSelectModal(discord.ui.Modal):
+    """Выбор предметов для обмена; инвентарь читается в момент открытия окна"""
+
+    def __init__(self, session: TradeSession, is_initiator: bool):
+        super().__init__(title="Выберите предметы для обмена")
+        self.session = session
+        self.is_initiator = is_initiator
         
-        # Инициатор
-        if server_id not in inventory:
-            inventory[server_id] = {}
-        if str(self.initiator.id) not in inventory[server_id]:
-            inventory[server_id][str(self.initiator.id)] = []
-        if str(self.recipient.id) not in inventory[server_id]:
-            inventory[server_id][str(self.recipient.id)] = []
+        member = session.initiator if is_initiator else session.recipient
+        self.offered = list(session.holdings(member.id).items())[:5]  # Ограничение на 5 предметов для простоты
+        for item, owned in self.offered:
+            self.add_item(discord.ui.TextInput(
+                label=item[:45],
+                placeholder=f"Количество, у вас {owned} (0 для исключения)",
+                default="1",
+                required=False
+            ))
+
+    async def on_submit(self, interaction: discord.Interaction):
+        selected_items = {}
         
-        # Удаляем предметы у инициатора и добавляем получателю
-        for item in self.initiator_items:
-            if item in inventory[server_id][str(self.initiator.id)]:
-                inventory[server_id][str(self.initiator.id)].remove(item)
-                inventory[server_id][str(self.recipient.id)].append(item)
+        for i, (item, owned) in enumerate(self.offered):
+            try:
+                count = int(self.children[i].value or "0")
+                if count > 0:
+                    selected_items[item] = min(count, owned)
+            except ValueError:
+                pass
         
-        # Удаляем предметы у получателя и добавляем инициатору
-        for item in self.recipient_items:
-            if item in inventory[server_id][str(self.recipient.id)]:
-                inventory[server_id][str(self.recipient.id)].remove(item)
-                inventory[server_id][str(self.initiator.id)].append(item)
+        if not trades.active(self.session):
+            return await interaction.response.send_message("❌ Этот обмен уже завершен!", ephemeral=True)
+        self.session.set_offer(self.is_initiator, items=selected_items)
+        await interaction.response.edit_message(embed=self.session.create_embed())
+
+class CurrencySelectModal(discord.ui.Modal):
+    """Выбор валюты для обмена"""
+
+    def __init__(self, session: TradeSession, is_initiator: bool):
+        super().__init__(title="Выберите валюту для обмена")
+        self.session = session
+        self.is_initiator = is_initiator
         
-        save_data(inventory, INVENTORY_FILE)
+        for currency in CURRENCIES:
+            self.add_item(discord.ui.TextInput(
+                label=f"{currency} ({CURRENCIES[currency]})",
+                placeholder="Введите сумму (0 для исключения)",
+                default="0",
+                required=False
+            ))
+
+    async def on_submit(self, interaction: discord.Interaction):
+        if not trades.active(self.session):
+            return await interaction.response.send_message("❌ Этот обмен уже завершен!", ephemeral=True)
+        currency_dict = {}
         
-        # Обновляем валюту
-        for currency, amount in self.initiator_currency.items():
-            CurrencySystem.update_balance(server_id, str(self.initiator.id), currency, -amount)
-            CurrencySystem.update_balance(server_id, str(self.recipient.id), currency, amount)
-            
-        for currency, amount in self.recipient_currency.items():
-            CurrencySystem.update_balance(server_id, str(self.recipient.id), currency, -amount)
-            CurrencySystem.update_balance(server_id, str(self.initiator.id), currency, amount)
+        for i, currency in enumerate(CURRENCIES):
+            try:
+                amount = int(self.children[i].value or "0")
+                if amount > 0:
+                    # Проверяем баланс (с учетом валюты, уже отданной в эскроу этого обмена)
+                    balance = self.session.balance(interaction.user.id, currency)
+                    if balance < amount:
+                        await interaction.response.send_message(
+                            f"❌ Недостаточно {currency}! Ваш баланс: {balance}",
+                            ephemeral=True
+                        )
+                        return
+                    currency_dict[currency] = amount
+            except ValueError:
+                pass
+        
+        self.session.set_offer(self.is_initiator, currency=currency_dict)
+        await interaction.response.edit_message(embed=self.session.create_embed())
 
 # Команда для начала обмена
 @bot.command(name='обмен')
@@ -1644,165 +4221,29 @@ async def trade(ctx, member: discord.Member):
     if member == ctx.author:
         return await ctx.send("❌ Нельзя обмениваться с самим собой!")
     
-    # Загружаем инвентари
-    inventory = load_data(INVENTORY_FILE)
-    server_id = str(ctx.guild.id)
-    
-    initiator_items = inventory.get(server_id, {}).get(str(ctx.author.id), [])
-    recipient_items = inventory.get(server_id, {}).get(str(member.id), [])
-    
-    # Создаем интерфейс обмена
-    view = TradeView(ctx, ctx.author, member, [], [], {}, {})
-    embed = await view.update_embed()
-    
-    # Создаем View для выбора предметов
-    class TradeSetupView(View):
-        def __init__(self, trade_view: TradeView):
-            super().__init__(timeout=300)
-            self.trade_view = trade_view
-            
-        @discord.ui.button(label="Выбрать предметы", style=discord.ButtonStyle.blurple)
-        async def select_items(self, interaction: discord.Interaction, button: discord.ui.Button):
-            if interaction.user.id not in [self.trade_view.initiator.id, self.trade_view.recipient.id]:
-                await interaction.response.send_message("❌ Вы не участник этого обмена!", ephemeral=True)
-                return
-                
-            # Создаем модальное окно для выбора предметов
-            modal = ItemSelectModal(self.trade_view, interaction.user.id == self.trade_view.initiator.id)
-            await interaction.response.send_modal(modal)
-            
-        @discord.ui.button(label="Выбрать валюту", style=discord.ButtonStyle.blurple)
-        async def select_currency(self, interaction: discord.Interaction, button: discord.ui.Button):
-            if interaction.user.id not in [self.trade_view.initiator.id, self.trade_view.recipient.id]:
-                await interaction.response.send_message("❌ Вы не участник этого обмена!", ephemeral=True)
-                return
-                
-            # Создаем модальное окно для выбора валюты
-            modal = CurrencySelectModal(self.trade_view, interaction.user.id == self.trade_view.initiator.id)
-            await interaction.response.send_modal(modal)
-            
-        @discord.ui.button(label="Подтвердить обмен", style=discord.ButtonStyle.green)
-        async def confirm_trade(self, interaction: discord.Interaction, button: discord.ui.Button):
-            if interaction.user.id not in [self.trade_view.initiator.id, self.trade_view.recipient.id]:
-                await interaction.response.send_message("❌ Вы не участник этого обмена!", ephemeral=True)
-                return
-                
-            self.trade_view.confirmations.add(interaction.user.id)
-            
-            if len(self.trade_view.confirmations) == 2:
-                # Оба подтвердили - выполняем обмен
-                await self.trade_view.execute_trade()
-                embed = await self.trade_view.update_embed()
-                embed.title = "✅ Обмен завершен!"
-                embed.color = discord.Color.green()
-                await interaction.response.edit_message(embed=embed, view=None)
-                self.stop()
-            else:
-                # Ждем второго подтверждения
-                embed = await self.trade_view.update_embed()
-                await interaction.response.edit_message(embed=embed)
-                
-        @discord.ui.button(label="Отменить обмен", style=discord.ButtonStyle.red)
-        async def cancel_trade(self, interaction: discord.Interaction, button: discord.ui.Button):
-            if interaction.user.id not in [self.trade_view.initiator.id, self.trade_view.recipient.id]:
-                await interaction.response.send_message("❌ Вы не участник этого обмена!", ephemeral=True)
-                return
-                
-            embed = discord.Embed(
-                title="❌ Обмен отменен",
-                description=f"{interaction.user.mention} отменил обмен",
-                color=discord.Color.red()
-            )
-            await interaction.response.edit_message(embed=embed, view=None)
-            self.stop()
-    
-    # Модальное окно для выбора предметов
-    class ItemSelectModal(discord.ui.Modal):
-        def __init__(self, trade_view: TradeView, is_initiator: bool):
-            super().__init__(title="Выберите предметы для обмена")
-            self.trade_view = trade_view
-            self.is_initiator = is_initiator
-            
-            items = initiator_items if is_initiator else recipient_items
-            for i, item in enumerate(items[:5]):  # Ограничение на 5 предметов для простоты
-                self.add_item(discord.ui.TextInput(
-                    label=f"Предмет {i+1}",
-                    placeholder="Введите количество (0 для исключения)",
-                    default="1",
-                    required=False
-                ))
-                
-        async def on_submit(self, interaction: discord.Interaction):
-            items = initiator_items if self.is_initiator else recipient_items
-            selected_items = []
-            
-            for i, item in enumerate(items[:5]):
-                try:
-                    count = int(self.children[i].value or "0")
-                    if count > 0 and item in items:
-                        selected_items.extend([item] * count)
-                except ValueError:
-                    pass
-                    
-            if self.is_initiator:
-                self.trade_view.initiator_items = selected_items
-            else:
-                self.trade_view.recipient_items = selected_items
-                
-            embed = await self.trade_view.update_embed()
-            await interaction.response.edit_message(embed=embed)
-    
-    # Модальное окно для выбора валюты
-    class CurrencySelectModal(discord.ui.Modal):
-        def __init__(self, trade_view: TradeView, is_initiator: bool):
-            super().__init__(title="Выберите валюту для обмена")
-            self.trade_view = trade_view
-            self.is_initiator = is_initiator
-            
-            for currency in CURRENCIES:
-                self.add_item(discord.ui.TextInput(
-                    label=f"{currency} ({CURRENCIES[currency]})",
-                    placeholder="Введите сумму (0 для исключения)",
-                    default="0",
-                    required=False
-                ))
-                
-        async def on_submit(self, interaction: discord.Interaction):
-            currency_dict = {}
-            
-            for i, currency in enumerate(CURRENCIES):
-                try:
-                    amount = int(self.children[i].value or "0")
-                    if amount > 0:
-                        # Проверяем баланс
-                        balance = CurrencySystem.get_balance(
-                            str(interaction.guild.id),
-                            str(interaction.user.id),
-                            currency
-                        )
-                        if balance < amount:
-                            await interaction.response.send_message(
-                                f"❌ Недостаточно {currency}! Ваш баланс: {balance}",
-                                ephemeral=True
-                            )
-                            return
-                        currency_dict[currency] = amount
-                except ValueError:
-                    pass
-                    
-            if self.is_initiator:
-                self.trade_view.initiator_currency = currency_dict
-            else:
-                self.trade_view.recipient_currency = currency_dict
-                
-            embed = await self.trade_view.update_embed()
-            await interaction.response.edit_message(embed=embed)
+    session = trades.start(ctx.guild, ctx.author, member)
+    if session is None:
+        return await ctx.send("❌ У вас или у этого игрока уже есть активный обмен!")
     
     # Отправляем начальное сообщение с кнопками
-    setup_view = TradeSetupView(view)
+    session.view = TradeSetupView(session)
+    embed = session.create_embed()
     embed.set_footer(text="Используйте кнопки ниже для настройки обмена")
-    await ctx.send(embed=embed, view=setup_view)
+    try:
+        session.message = await ctx.send(embed=embed, view=session.view)
+    except discord.HTTPException:
+        trades.end(session)
+        raise
 
 # ... (остальные команды add_item, remove_item и т.д. остаются без изменений)
 
-bot.run(process.env.TOKEN)  # Замените на реальный токен
+if __name__ == '__main__':
+    if '--migrate-sqlite' in sys.argv:
+        # Одноразовый перенос: python bot.py --migrate-sqlite, затем запуск с STORAGE_BACKEND=sqlite
+        migrate_json_to_sqlite()
+    elif '--split-guilds' in sys.argv:
+        # Одноразовое разделение по серверам: python bot.py --split-guilds, затем запуск с SHARD_COUNT
+        migrate_json_to_guild_dirs()
+    else:
+        bot.run(os.getenv('TOKEN'))  # Токен берется из переменной окружения TOKEN
+        store.flush()  # Сбрасываем несохраненные изменения после остановки бота